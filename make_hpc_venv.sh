@@ -4,7 +4,7 @@ module load python/3.8
 virtualenv ~/cdcbirth
 source ~/cdcbirth/bin/activate
 pip install --no-index --upgrade pip
-pip install --no-index pandas scipy scikit_learn matplotlib seaborn plotly
+pip install --no-index pandas pyarrow scipy scikit_learn matplotlib seaborn plotly
 pip install --no-index jupyterlab
 # pip install python-dotenv # don't think I need this????
 
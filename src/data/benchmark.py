@@ -0,0 +1,366 @@
+"""Benchmarks of the data pipeline on synthetic birth record csvs.
+
+Csvs are generated in each of the formats of the historical birth records
+(1968-1988, 1989-2002, 2003-2018 and 2019-2020, see schema.SCHEMAS), and
+from before apgar5 was recorded (1978), at a range of sizes. The readers (df_from_csv_*) are timed and memory profiled on them,
+as are df_birth_no_geo_prep and percentage_birts_by_month on tables of the
+same number of rows. Each run is added to a JSON history, and compared with
+the previous run, so that slowdowns are caught before a long HPC job.
+
+Run with, for example:
+    python src/data/benchmark.py --rows 1000 100000 4000000
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import platform
+import shutil
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.data.data_prep_utils import (
+    df_from_csv_with_geo,
+    df_from_csv_no_geo,
+    df_from_csv_no_geo_extra,
+    df_birth_no_geo_prep,
+    percentage_birts_by_month,
+    load_state_fips,
+    load_state_abbr,
+    GEO_FIELDS,
+)
+from src.data.schema import get_schema, get_year, fields_available
+
+# a year in each format of the csvs (see schema.SCHEMAS): without apgar5
+# (before 1978), with geo data (1982-2004), and with capitalized columns (2019 on)
+SCHEMA_YEARS = [1975, 1985, 1995, 2004, 2019]
+
+# number of columns, other than the ones read, in each synthetic csv
+N_OTHER_COLUMNS = 20
+
+# csvs from the external data folder needed by the readers
+EXTERNAL_FILES = ["all-geocodes-v2017.csv", "state_abbreviations.csv"]
+
+# readers benchmarked on each csv, with the fields they need
+# (a reader is skipped for years without them, as it reads nothing then)
+READERS = [
+    (df_from_csv_with_geo, GEO_FIELDS),
+    (df_from_csv_no_geo, ["dob_yy", "dob_mm"]),
+    (df_from_csv_no_geo_extra, ["dob_yy", "dob_mm", "apgar5"]),
+]
+
+# slowdowns of less than this many seconds are taken as noise
+MIN_REGRESSION_SECONDS = 0.05
+
+
+def make_synthetic_csv(file_path, year, n_rows, folder_external, seed=0):
+    """Write a synthetic birth record csv in the format of a year's csv.
+
+    The fields read by the pipeline that are recorded in the year (see
+    schema.SCHEMAS and schema.FIELD_YEARS) get random values coded as in
+    the real csvs, and N_OTHER_COLUMNS columns of random numbers stand in
+    for the rest of the columns.
+    """
+
+    rng = np.random.default_rng(seed)
+    schema = get_schema(year)
+
+    df_fips = load_state_fips(folder_external)
+    state_fips = df_fips["state_fips"][df_fips["state_fips"] != "00"].to_numpy()
+    state_abbr = load_state_abbr(folder_external)["abbr"].to_numpy()
+
+    states = rng.choice(state_fips, n_rows)
+    counties = rng.integers(1, 200, n_rows) * 2 - 1
+
+    values = {
+        "dob_yy": np.full(
+            n_rows, year % 10 if schema.get("single_digit_year", False) else year
+        ),
+        "dob_mm": rng.integers(1, 13, n_rows),
+        "dob_wk": rng.integers(1, 8, n_rows),
+        "dob_day": rng.integers(1, 29, n_rows),
+        "apgar5": rng.choice(np.append(np.arange(1, 11), 99), n_rows),
+        "mrcityfips": np.full(n_rows, "999"),
+    }
+
+    # the state is an abbreviation from 2003 on, and the county is given
+    # without the state (or leading zeros)
+    if year >= 2003:
+        values["mrstate"] = rng.choice(state_abbr, n_rows)
+        values["mrcntyfips"] = counties.astype(str)
+    else:
+        values["mrstate"] = states
+        values["mrcntyfips"] = np.char.add(
+            states.astype(str), np.char.zfill(counties.astype(str), 3)
+        )
+
+    df = pd.DataFrame(
+        {
+            column: values[field]
+            for field, column in schema["columns"].items()
+            if field in values and fields_available(year, [field])
+        }
+    )
+    for i in range(N_OTHER_COLUMNS):
+        df[f"other{i}"] = rng.integers(0, 100, n_rows)
+
+    Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+    df.to_csv(file_path, index=False)
+
+
+def make_synthetic_data(folder_benchmark, n_rows, folder_external, seed=0):
+    """Make the synthetic csvs of each of the SCHEMA_YEARS with n_rows rows,
+    laid out like the data folder (raw and external) so the readers find
+    the external data. Csvs made by earlier runs are reused.
+
+    Returns:
+        list: Paths of the synthetic csvs.
+    """
+
+    folder_data = Path(folder_benchmark) / f"rows_{n_rows}"
+    (folder_data / "external").mkdir(parents=True, exist_ok=True)
+    for file_name in EXTERNAL_FILES:
+        shutil.copy(Path(folder_external) / file_name, folder_data / "external")
+
+    file_list = []
+    for year in SCHEMA_YEARS:
+        file_path = folder_data / "raw" / f"natl{year}.csv"
+        if not file_path.exists():
+            make_synthetic_csv(file_path, year, n_rows, folder_external, seed=seed)
+        file_list.append(file_path)
+
+    return file_list
+
+
+def make_synthetic_births(n_rows, seed=0):
+    """Make a synthetic table of births by year and month (like
+    births_simple.csv) with n_rows rows.
+    """
+    rng = np.random.default_rng(seed)
+    months = np.arange(n_rows)
+    return pd.DataFrame(
+        {
+            "dob_yy": 1968 + months // 12,
+            "dob_mm": months % 12 + 1,
+            "births": rng.integers(200000, 400000, n_rows),
+        }
+    )
+
+
+def measure(func, repeat=3):
+    """Time func (the best of repeat runs) and then profile its peak memory.
+
+    The memory is that of the Python and numpy allocations (with tracemalloc),
+    which are also what pandas uses. Prints from func are silenced.
+
+    Returns:
+        dict: seconds and peak_mb of func
+    """
+
+    seconds = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            seconds.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        try:
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return {"seconds": min(seconds), "peak_mb": peak / 2 ** 20}
+
+
+def run_benchmarks(folder_benchmark, rows_list, folder_external, repeat=3):
+    """Run every benchmark at each number of rows.
+
+    Returns:
+        list: A dict per benchmark, with its name, year (None for those not
+            reading a csv), rows, seconds and peak_mb.
+    """
+    logger = logging.getLogger(__name__)
+
+    results = []
+    for n_rows in rows_list:
+        logger.info(f"making the synthetic data with {n_rows} rows")
+        file_list = make_synthetic_data(folder_benchmark, n_rows, folder_external)
+
+        for file_path in file_list:
+            year = get_year(file_path)
+            for reader, fields in READERS:
+                if not fields_available(year, fields):
+                    continue
+
+                logger.info(f"benchmarking {reader.__name__} on {file_path.name}")
+                results.append(
+                    {
+                        "name": reader.__name__,
+                        "year": year,
+                        "rows": n_rows,
+                        **measure(lambda: reader(file_path), repeat=repeat),
+                    }
+                )
+
+        df = make_synthetic_births(n_rows)
+        df_prep = df_birth_no_geo_prep(df)
+        for name, func in [
+            ("df_birth_no_geo_prep", lambda: df_birth_no_geo_prep(df)),
+            ("percentage_birts_by_month", lambda: percentage_birts_by_month(df_prep)),
+        ]:
+            logger.info(f"benchmarking {name}")
+            results.append(
+                {
+                    "name": name,
+                    "year": None,
+                    "rows": n_rows,
+                    **measure(func, repeat=repeat),
+                }
+            )
+
+    return results
+
+
+def get_git_commit(project_dir):
+    """Get the commit the project is at (None if it is not a git repo)."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=project_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path_history):
+    """Load the runs recorded in a benchmark history (a JSON list)."""
+    if Path(path_history).exists():
+        return json.loads(Path(path_history).read_text())
+    return []
+
+
+def compare_runs(results, previous, tolerance=0.2):
+    """Compare the results of a run with those of a previous run.
+
+    Returns:
+        pd.DataFrame: The results, with the seconds of the previous run and
+            a regression column, True for benchmarks over tolerance (a
+            fraction) and MIN_REGRESSION_SECONDS slower than before.
+    """
+
+    key = ["name", "year", "rows"]
+    df = pd.DataFrame(results)
+    df["year"] = df["year"].astype("Int64")
+
+    if previous is None:
+        df["previous_seconds"] = np.nan
+    else:
+        df_previous = pd.DataFrame(previous["results"])[key + ["seconds"]]
+        df_previous["year"] = df_previous["year"].astype("Int64")
+        df = df.merge(
+            df_previous.rename(columns={"seconds": "previous_seconds"}),
+            on=key,
+            how="left",
+        )
+
+    slowdown = df["seconds"] - df["previous_seconds"]
+    df["regression"] = (slowdown > df["previous_seconds"] * tolerance) & (
+        slowdown > MIN_REGRESSION_SECONDS
+    )
+    return df
+
+
+def main(folder_benchmark, path_history, rows_list, repeat=3, tolerance=0.2):
+    """Run the benchmarks, add them to the history and print how they
+    compare with the previous run.
+
+    Returns:
+        pd.DataFrame: The comparison (see compare_runs).
+    """
+
+    project_dir = Path(__file__).resolve().parents[2]
+
+    results = run_benchmarks(
+        folder_benchmark, rows_list, project_dir / "data/external", repeat=repeat
+    )
+
+    history = load_history(path_history)
+    df = compare_runs(results, history[-1] if history else None, tolerance=tolerance)
+
+    history.append(
+        {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "commit": get_git_commit(project_dir),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "results": results,
+        }
+    )
+    Path(path_history).parent.mkdir(parents=True, exist_ok=True)
+    Path(path_history).write_text(json.dumps(history, indent=2))
+
+    print(df.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+    return df
+
+
+if __name__ == "__main__":
+    log_fmt = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    parser = argparse.ArgumentParser(description="Benchmark the data pipeline")
+
+    parser.add_argument(
+        "--rows",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+        help="Numbers of rows of the synthetic csvs (e.g. 1000 100000 4000000)",
+    )
+
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Number of times each benchmark is timed (the best time is kept)",
+    )
+
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Fraction slower than the previous run that counts as a regression",
+    )
+
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Exit with an error if any benchmark regressed",
+    )
+
+    args = parser.parse_args()
+
+    project_dir = Path(__file__).resolve().parents[2]
+
+    df = main(
+        project_dir / "data/interim/benchmark",
+        project_dir / "reports/benchmarks.json",
+        args.rows,
+        repeat=args.repeat,
+        tolerance=args.tolerance,
+    )
+
+    if args.check and df["regression"].any():
+        raise SystemExit(f"{df['regression'].sum()} benchmarks regressed")
@@ -0,0 +1,194 @@
+"""Memory-mapped binary store of the per-birth geo table (births_with_geo_apgar).
+
+The store is a folder holding one raw binary file per column, of fixed width
+numbers, and a small header (header.json) describing them. Columns of codes
+or names (e.g. mrcntyfips or state_name_mr) are stored as integer codes into
+a list of categories kept in the header. The rows are sorted by year and
+state, and the header records the rows of each, so a year or a state can be
+read by slicing the memory-mapped columns, without parsing anything.
+"""
+
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+HEADER_NAME = "header.json"
+
+# columns the rows are sorted by, and indexed on in the header
+INDEX_COLUMNS = ["dob_yy", "mrstatefips"]
+
+
+def get_code_dtype(n_categories):
+    """Get the smallest unsigned int dtype that can hold the codes of
+    n_categories (plus one code for missing values).
+    """
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if n_categories < np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def encode_column(values):
+    """Turn a column into fixed width numbers.
+
+    Returns:
+        tuple: (array of numbers, list of the categories the numbers are codes
+            into, or None if the column holds numbers already)
+    """
+
+    if pd.api.types.is_integer_dtype(values.dtype) and not values.isna().any():
+        dtype = f"{values.dtype.kind}{values.dtype.itemsize}"
+        return values.to_numpy(dtype=dtype), None
+
+    values = pd.Categorical(values.astype("category").cat.remove_unused_categories())
+    categories = [str(category) for category in values.categories]
+
+    # missing values get the largest code
+    codes = values.codes.astype(np.int64)
+    codes[codes < 0] = len(categories)
+    return codes.astype(get_code_dtype(len(categories))), categories
+
+
+def write_store(df, path_store):
+    """Write a per-birth table to a memory-mapped binary store.
+
+    Args:
+        df (pd.DataFrame): The table, with the INDEX_COLUMNS among its columns.
+        path_store (Path): Folder to write the store to. Replaced if it exists.
+    """
+
+    path_store = Path(path_store)
+    if path_store.exists():
+        shutil.rmtree(path_store)
+    path_store.mkdir(parents=True)
+
+    # sort the rows by year and state, keeping their order otherwise
+    df = df.sort_values(by=INDEX_COLUMNS, kind="stable").reset_index(drop=True)
+
+    header = {"n_rows": len(df), "columns": [], "index": []}
+    encoded = {}
+    for column in df.columns:
+        values, categories = encode_column(df[column])
+        values.tofile(path_store / f"{column}.bin")
+
+        encoded[column] = values
+        header["columns"].append(
+            {"name": column, "dtype": values.dtype.str, "categories": categories}
+        )
+
+    # record the rows of each year and state
+    keys = np.stack([encoded[column] for column in INDEX_COLUMNS], axis=1)
+    if len(keys) > 0:
+        starts = np.flatnonzero(np.any(keys[1:] != keys[:-1], axis=1)) + 1
+        starts = np.concatenate([[0], starts])
+        stops = np.concatenate([starts[1:], [len(keys)]])
+        for start, stop in zip(starts, stops):
+            entry = {
+                column: decode_value(header, column, keys[start, i])
+                for i, column in enumerate(INDEX_COLUMNS)
+            }
+            entry["start"], entry["stop"] = int(start), int(stop)
+            header["index"].append(entry)
+
+    (path_store / HEADER_NAME).write_text(json.dumps(header, indent=2))
+
+
+def read_header(path_store):
+    """Read the header of a binary store."""
+    return json.loads((Path(path_store) / HEADER_NAME).read_text())
+
+
+def decode_value(header, column, value):
+    """Turn a stored number of a column back into its value."""
+    info = next(info for info in header["columns"] if info["name"] == column)
+    if info["categories"] is None:
+        return int(value)
+    return info["categories"][int(value)]
+
+
+def open_store(path_store):
+    """Open the columns of a binary store as memory-mapped arrays.
+    Nothing is read from disk until the arrays are accessed.
+
+    Returns:
+        tuple: (header, dict of the memory-mapped array of each column)
+    """
+
+    path_store = Path(path_store)
+    header = read_header(path_store)
+
+    columns = {}
+    for info in header["columns"]:
+        # empty files cannot be memory-mapped
+        if header["n_rows"] == 0:
+            columns[info["name"]] = np.empty(0, dtype=info["dtype"])
+        else:
+            columns[info["name"]] = np.memmap(
+                path_store / f"{info['name']}.bin",
+                dtype=info["dtype"],
+                mode="r",
+                shape=(header["n_rows"],),
+            )
+
+    return header, columns
+
+
+def get_row_ranges(header, year=None, state_fips=None):
+    """Get the (start, stop) rows of a year and/or state (its FIPS code, e.g.
+    "01"), merging adjacent ranges. All the rows if neither is given.
+    """
+
+    ranges = []
+    for entry in header["index"]:
+        if year is not None and entry["dob_yy"] != year:
+            continue
+        if state_fips is not None and entry["mrstatefips"] != state_fips:
+            continue
+
+        if ranges and ranges[-1][1] == entry["start"]:
+            ranges[-1] = (ranges[-1][0], entry["stop"])
+        else:
+            ranges.append((entry["start"], entry["stop"]))
+
+    if year is None and state_fips is None:
+        return [(0, header["n_rows"])]
+    return ranges
+
+
+def read_store(path_store, year=None, state_fips=None, columns=None):
+    """Read the rows of a year and/or state from a binary store into a dataframe.
+
+    Args:
+        path_store (Path): Folder of the store.
+        year (int): Only read the births of this year.
+        state_fips (str): Only read the births of this state (e.g. "01").
+        columns (list): Columns to read. All of them if None.
+
+    Returns:
+        pd.DataFrame: The rows, with the columns of categories as categoricals.
+    """
+
+    header, arrays = open_store(path_store)
+    ranges = get_row_ranges(header, year=year, state_fips=state_fips)
+
+    data = {}
+    for info in header["columns"]:
+        if columns is not None and info["name"] not in columns:
+            continue
+
+        values = np.concatenate(
+            [arrays[info["name"]][start:stop] for start, stop in ranges]
+            or [np.empty(0, dtype=info["dtype"])]
+        )
+
+        if info["categories"] is not None:
+            codes = values.astype(np.int64)
+            codes[codes == len(info["categories"])] = -1
+            values = pd.Categorical.from_codes(codes, categories=info["categories"])
+
+        data[info["name"]] = values
+
+    return pd.DataFrame(data)
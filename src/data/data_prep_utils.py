@@ -1,384 +1,1109 @@
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 from pathlib import Path
-import pathlib
 import os
+import re
+import io
 import zipfile
-from multiprocessing import Pool
+from contextlib import contextmanager
 import datetime
-from dateutil.relativedelta import relativedelta
+import json
+import logging
+from functools import lru_cache
+from src.data.instrument import stage
+from src.data.schema import (
+    get_year,
+    get_schema,
+    fields_available,
+    available_fields,
+    resolve_columns,
+    resolve_layout,
+    FIELD_DTYPES,
+)
 
 
-def df_from_csv_with_geo(file_path, nrows=None):
-    """Extract useful columns from birth record csv
-    Takes a csv path. CSV must be before 2005 to include geo data.
+###############################################################################
+# Columnar cache of the raw birth record csvs
+###############################################################################
+
+
+def get_cache_path(file_path):
+    """Get the path of the cached (parquet) version of a birth record csv.
+    The cache lives in data/interim, next to data/raw.
     """
+    file_path = Path(file_path)
+    return file_path.parent.parent / "interim" / f"natl{get_year(file_path)}.parquet"
 
-    # get year of CSV
-    year = int(str(file_path).split("/")[-1][4:8])
-    # print(year)
 
-    # no geo data before 1982 or after 2004
-    if year > 2004 or year < 1982:
-        pass
+# key of the parquet metadata holding the fingerprint of the cached csv
+CACHE_SOURCE_KEY = b"source_fingerprint"
+
+
+def get_source_fingerprint(file_path):
+    """Get the fingerprint (size and mtime) of a raw csv, stored with its
+    cache so that a cache of an older version of the csv is not used.
+    """
+    stat = Path(file_path).stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def read_cache_fingerprint(cache_path):
+    """Read the fingerprint of the csv a cache was made from (see
+    csv_to_cache), or None if it was not recorded.
+    """
+    import pyarrow.parquet as pq
+
+    metadata = pq.read_schema(cache_path).metadata or {}
+    if CACHE_SOURCE_KEY not in metadata:
+        return None
+    return json.loads(metadata[CACHE_SOURCE_KEY])
+
+
+def is_cache_stale(file_path):
+    """Check if the cache of a raw csv exists, but was made from another
+    version of the csv (or does not record which), so it must not be used.
+    """
+    cache_path = get_cache_path(file_path)
+    return (
+        cache_path.exists()
+        and read_cache_fingerprint(cache_path) != get_source_fingerprint(file_path)
+    )
+
+
+def get_current_cache_path(file_path):
+    """Get the path of the cache of a raw csv, if it exists and was made
+    from the csv as it is now (see csv_to_cache), or else None.
+    """
+    cache_path = get_cache_path(file_path)
+    if not cache_path.exists() or is_cache_stale(file_path):
+        return None
+    return cache_path
+
+
+def get_cache_fingerprint(file_path):
+    """Get the fingerprint (size and mtime) of the current cache of a raw
+    csv (see get_current_cache_path), or None if the csv is read instead.
+    """
+    cache_path = get_current_cache_path(file_path)
+    if cache_path is None:
+        return None
+    return get_source_fingerprint(cache_path)
+
+
+def csv_to_cache(file_path, chunksize=500000):
+    """Convert a birth record csv to a compressed parquet file in data/interim.
+
+    All the fields of the year (see schema.FIELDS) are kept, under their
+    field names. Numbers are stored as small unsigned integers, and codes
+    (like FIPS) as dictionary encoded strings so that they keep their
+    leading zeros. The size and mtime of the csv are stored in the metadata
+    of the parquet file, so the cache is not used once the csv changes (see
+    get_current_cache_path).
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    year = get_year(file_path)
+    fields = available_fields(year)
+
+    # fingerprint the csv before reading it, so a change while reading is caught
+    source_fingerprint = json.dumps(get_source_fingerprint(file_path)).encode()
+
+    cache_path = get_cache_path(file_path)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+
+    arrow_types = {
+        "UInt8": pa.uint8(),
+        "UInt16": pa.uint16(),
+        "category": pa.dictionary(pa.int32(), pa.string()),
+    }
+    schema = pa.schema(
+        [(field, arrow_types[FIELD_DTYPES[field]]) for field in fields],
+        metadata={CACHE_SOURCE_KEY: source_fingerprint},
+    )
+
+    with pq.ParquetWriter(cache_path, schema, compression="zstd") as writer:
+        for df in read_fields_raw(file_path, fields, chunksize=chunksize):
+            writer.write_table(
+                pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+            )
+
+    print(f'{year} cache complete')
+    return cache_path
+
+
+def read_fields_cache(cache_path, fields, nrows=None, chunksize=None):
+    """Read select fields from a cached birth record csv (see csv_to_cache).
+    An iterator of dataframes is returned when a chunksize is given.
+    """
+    import pyarrow.parquet as pq
+
+    def to_frame(table):
+        # same dtypes as when reading the csv
+        with stage("cast", get_year(cache_path), rows_in=table.num_rows) as record:
+            df = table.to_pandas()
+            record["rows_out"] = len(df)
+            return df.astype({field: FIELD_DTYPES[field] for field in df.columns})
+
+    parquet_file = pq.ParquetFile(cache_path)
+
+    if chunksize is None:
+        table = parquet_file.read(columns=fields)
+        if nrows is not None:
+            table = table.slice(0, nrows)
+        return to_frame(table)
+
+    def read_chunks():
+        rows_left = nrows
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=fields):
+            if rows_left is not None:
+                if rows_left <= 0:
+                    break
+                batch = batch.slice(0, rows_left)
+                rows_left -= batch.num_rows
+            yield to_frame(batch)
+
+    return read_chunks()
+
+
+###############################################################################
+# Functions for extracting data from the raw birth record csvs
+###############################################################################
+
+
+def get_zip_member(zip_file):
+    """Get the name of the birth record csv in a downloaded zip archive.
+    The csvs are not all named alike (e.g. natl2018us.csv, birth_2019_nber_us.csv).
+    """
+    csv_names = [name for name in zip_file.namelist() if name.lower().endswith(".csv")]
+    if len(csv_names) != 1:
+        raise ValueError(f"Expected one csv in {zip_file.filename}, found {csv_names}")
+    return csv_names[0]
+
+
+def list_raw_files(folder_raw_data):
+    """List the birth record csvs in the raw data folder, one per year.
+
+    Extracted csvs (natlYYYY.csv) are used where they exist. Otherwise the
+    downloaded zip archives (natlYYYY.csv.zip, birth_YYYY_nber_us.zip) are
+    read directly, so the extract step can be skipped. Fixed-width files
+    (natlYYYY.dat) are read in place of both when the data dictionary giving
+    their layout (desc/YYYY.dct, see read_fields_fwf) is there too.
+    """
+    file_list = {}
+    for filename in sorted(os.listdir(folder_raw_data)):
+        if re.fullmatch(r"natl\d{4}\.dat", filename):
+            file_path = Path(folder_raw_data) / filename
+            if (get_desc_dir(file_path) / f"{get_year(filename)}.dct").exists():
+                file_list[get_year(filename)] = file_path
+
+    for filename in sorted(os.listdir(folder_raw_data)):
+        if re.fullmatch(r"natl\d{4}\.csv", filename):
+            file_list.setdefault(get_year(filename), Path(folder_raw_data) / filename)
+
+    for filename in sorted(os.listdir(folder_raw_data)):
+        if re.fullmatch(r"(natl\d{4}(us)?\.csv|birth_\d{4}_nber_us)\.zip", filename):
+            file_list.setdefault(get_year(filename), Path(folder_raw_data) / filename)
+
+    return [file_list[year] for year in sorted(file_list)]
+
+
+class ByteRangeFile(io.RawIOBase):
+    """Read-only file holding the bytes from start to stop of an open file."""
+
+    def __init__(self, f, start, stop):
+        self.f = f
+        self.f.seek(start)
+        self.remaining = stop - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.f.readinto(memoryview(b)[: min(len(b), self.remaining)])
+        self.remaining -= n
+        return n
+
+
+def read_csv_header(file_path):
+    """Read the column names from the first line of a birth record csv."""
+    with open(file_path, "rb") as f:
+        return pd.read_csv(f, nrows=0).columns.tolist()
+
+
+def split_byte_ranges(file_path, n_parts):
+    """Split an (extracted) birth record csv into about n_parts byte ranges,
+    so that its parts can be read by separate workers.
+
+    The ranges start after the header and are aligned on the ends of lines,
+    so each holds whole records. Records never span lines in these csvs.
+
+    Returns:
+        list: (start, stop, header) of each byte range, where header holds the
+            column names of the csv, as they are only on its first line.
+    """
+
+    header = read_csv_header(file_path)
+    size = Path(file_path).stat().st_size
+
+    with open(file_path, "rb") as f:
+        f.readline()
+        boundaries = [f.tell()]
+
+        for i in range(1, n_parts):
+            target = boundaries[0] + (size - boundaries[0]) * i // n_parts
+            if target <= boundaries[-1]:
+                continue
+
+            # move on to the start of the next record
+            f.seek(target - 1)
+            f.readline()
+            if boundaries[-1] < f.tell() < size:
+                boundaries.append(f.tell())
+
+    boundaries.append(size)
+    return [
+        (start, stop, header) for start, stop in zip(boundaries[:-1], boundaries[1:])
+    ]
+
+
+@contextmanager
+def open_raw_csv(file_path, byte_range=None):
+    """Open a birth record csv (extracted, or in its zip archive) for reading.
+
+    Args:
+        file_path (Path): Path to the birth record csv.
+        byte_range (tuple): (start, stop, header) from split_byte_ranges.
+            Only the bytes from start to stop of the csv are read.
+
+    """
+
+    # stream the csv straight out of the downloaded zip archive
+    if str(file_path).endswith(".zip"):
+        with zipfile.ZipFile(file_path) as zip_file:
+            with zip_file.open(get_zip_member(zip_file)) as f:
+                yield f
+
+    elif byte_range is not None:
+        start, stop, _ = byte_range
+        with open(file_path, "rb") as f:
+            yield io.BufferedReader(ByteRangeFile(f, start, stop))
 
     else:
+        with open(file_path, "rb") as f:
+            yield f
 
-        # load FIPS code data
-        df_fips = pd.read_csv(
-            file_path.parent.parent / "external" / "all-geocodes-v2017.csv", dtype=str
-        )
 
-        # get the fips codes for the states only
-        df_fips = df_fips[
-            (df_fips["County Code (FIPS)"] == "000")
-            & (df_fips["County Subdivision Code (FIPS)"] == "00000")
-            & (df_fips["Place Code (FIPS)"] == "00000")
-            & (df_fips["Consolidtated City Code (FIPS)"] == "00000")
-        ][
-            [
-                "State Code (FIPS)",
-                "Area Name (including legal/statistical area description)",
-            ]
-        ]
+def set_full_year(df, year):
+    """Set dob_yy to the full year, for the years before 1989, which only
+    show a single digit (i.e. 2 for 1982).
+    """
+    if "dob_yy" in df.columns and get_schema(year).get("single_digit_year", False):
+        df["dob_yy"] = pd.Series(year, index=df.index, dtype=FIELD_DTYPES["dob_yy"])
+    return df
 
-        # rename columns in df
-        df_fips.columns = ["state_fips", "state_name_mr"]
 
-        # require differnt column names depending on year
-        # columns for 2003+
-        col_load_1 = [
-            "dob_yy",
-            "dob_mm",
-            "dob_wk",
-            "mrstate",
-            "mrcntyfips",
-            "mrcityfips",
-            "apgar5",
-        ]
+def read_fields_csv(file_path, fields, nrows=None, chunksize=None, byte_range=None):
+    """Read select fields (see schema.FIELDS) from a birth record csv.
+    An iterator of dataframes is returned when a chunksize is given.
+    With a byte_range (see split_byte_ranges), only that part of the csv is read.
+    """
 
-        # columns for 1989-2002
-        col_load_2 = [
-            "biryr",
-            "birmon",
-            "weekday",
-            "stresfip",
-            "cntyrfip",
-            "cityres",
-            "fmaps",
-        ]
-        rename_col2 = [
-            "dob_yy",
-            "dob_mm",
-            "dob_wk",
-            "mrstate",
-            "mrcntyfips",
-            "mrcityfips",
-            "apgar5",
-        ]
+    year = get_year(file_path)
+    columns = resolve_columns(year, fields)
+    col_rename_dict = {column: field for field, column in columns.items()}
 
-        # columns for 1982 through 1988
-        col_load_3 = [
-            "datayear",
-            "birmon",
-            "birday",
-            "stresfip",
-            "cntyrfip",
-            "cityres",
-            "fmaps",
-        ]
-        rename_col3 = [
-            "dob_yy",
-            "dob_mm",
-            "dob_day",
-            "mrstate",
-            "mrcntyfips",
-            "mrcityfips",
-            "apgar5",
-        ]
+    def to_frame(df):
+        with stage("rename", year, rows_in=len(df)) as record:
+            df = df.rename(columns=col_rename_dict)[fields]
+            record["rows_out"] = len(df)
+            return set_full_year(df, year)
 
-        # create dictionary to rename older csvs
-        col_rename_dict2 = dict(zip(col_load_2, rename_col2))
-        col_rename_dict3 = dict(zip(col_load_3, rename_col3))
-
-        # if the CSVs are of newer format
-        if year >= 2003:
-            # load abbreviation csv so we can rename AK to Alaska, etc.
-            df_abbr = pd.read_csv(
-                file_path.parent.parent / "external" / "state_abbreviations.csv",
-                header=None,
-                names=["state", "abbr"],
+    # the header is only on the first line of the csv
+    if byte_range is not None:
+        header_kwargs = {"header": None, "names": byte_range[2]}
+    else:
+        header_kwargs = {}
+
+    def read_chunks():
+        with open_raw_csv(file_path, byte_range=byte_range) as f:
+            reader = pd.read_csv(
+                f,
+                nrows=nrows,
+                usecols=list(columns.values()),
+                dtype={column: FIELD_DTYPES[field] for field, column in columns.items()},
+                chunksize=chunksize,
+                **header_kwargs,
             )
 
-            # load only select columns, and set dtype for columns
-            df = pd.read_csv(file_path, nrows=nrows, usecols=col_load_1, dtype=str)
-
-            # get the full state name and append them onto the df
-            df = (
-                pd.merge(
-                    df,
-                    df_abbr,
-                    left_on="mrstate",
-                    right_on="abbr",
-                    how="inner",
-                    copy=False,
-                )
-                .drop(["abbr"], axis=1)
-                .drop(["mrstate"], axis=1)
+            if chunksize is None:
+                yield to_frame(reader)
+            else:
+                for df in reader:
+                    yield to_frame(df)
+
+    if chunksize is None:
+        return next(read_chunks())
+    return read_chunks()
+
+
+def get_desc_dir(file_path):
+    """Get the folder of the data dictionaries of a raw birth record file
+    (data/raw/desc, see download_desc.sh).
+    """
+    return Path(file_path).parent / "desc"
+
+
+def decode_fwf_numbers(values, dtype):
+    """Decode a field of fixed-width records to a nullable integer array.
+
+    Args:
+        values (np.ndarray): 2-D array of the bytes of the field in each record.
+        dtype (str): Nullable integer dtype of the field (e.g. "UInt8").
+
+    Numbers may be padded with spaces on either side. Blank values, and
+    values with other characters than digits, are missing.
+    """
+
+    digits = values.astype(np.int64) - ord("0")
+    is_digit = (digits >= 0) & (digits <= 9)
+    is_space = values == ord(" ")
+
+    # spaces between the first and the last digit are not padding
+    after_first = np.logical_or.accumulate(is_digit, axis=1)
+    before_last = np.logical_or.accumulate(is_digit[:, ::-1], axis=1)[:, ::-1]
+    valid = (
+        is_digit.any(axis=1)
+        & (is_digit | is_space).all(axis=1)
+        & ~(after_first & before_last & is_space).any(axis=1)
+    )
+
+    powers = 10 ** np.arange(values.shape[1] - 1, -1, -1)
+    numbers = (np.where(is_digit, digits, 0) * powers).sum(axis=1)
+
+    # drop the zeros taken in by trailing spaces
+    numbers //= 10 ** (~before_last).sum(axis=1)
+    numbers[~valid] = 0
+    return pd.arrays.IntegerArray(numbers.astype(dtype.lower()), ~valid)
+
+
+def decode_fwf_codes(values):
+    """Decode a field of fixed-width records to a categorical of codes (e.g.
+    FIPS), stripped of spaces. Blank codes are missing.
+
+    Only the distinct codes are decoded to strings, as there are few of them.
+    """
+
+    codes = np.ascontiguousarray(values).view(f"S{values.shape[1]}").ravel()
+    uniques, inverse = np.unique(codes, return_inverse=True)
+
+    labels = pd.Series([code.decode("ascii", "replace").strip() for code in uniques])
+    label_codes, categories = pd.factorize(labels.replace("", np.nan))
+    return pd.Categorical.from_codes(label_codes[inverse.ravel()], categories)
+
+
+def read_fields_fwf(file_path, fields, nrows=None, chunksize=None, desc_dir=None):
+    """Read select fields (see schema.FIELDS) from a fixed-width birth record
+    file (natlYYYY.dat). An iterator of dataframes is returned when a
+    chunksize is given.
+
+    The byte offsets of the fields are taken from the year's Stata dictionary
+    in desc_dir (data/raw/desc by default, see schema.read_dct). The records
+    are read a chunk at a time into a 2-D array of bytes, and only the bytes
+    of the fields are sliced out and decoded, instead of tokenizing all the
+    columns of each record as for the csvs.
+    """
+
+    year = get_year(file_path)
+    if desc_dir is None:
+        desc_dir = get_desc_dir(file_path)
+    layout = resolve_layout(year, fields, desc_dir)
+
+    def to_frame(records):
+        with stage("cast", year, rows_in=len(records)) as record:
+            columns = {}
+            for field, (start, width, dtype) in zip(
+                layout.index, layout[["start", "width", "dtype"]].to_numpy()
+            ):
+                values = records[:, start : start + width]
+                if dtype == "category":
+                    columns[field] = decode_fwf_codes(values)
+                else:
+                    columns[field] = decode_fwf_numbers(values, dtype)
+
+            record["rows_out"] = len(records)
+            return set_full_year(pd.DataFrame(columns), year)
+
+    def read_chunks():
+        with open(file_path, "rb") as f:
+            # the records all have the same length (line ending included)
+            record_length = len(f.readline())
+            f.seek(0)
+
+            rows_left = nrows
+            while True:
+                n_rows = chunksize if chunksize is not None else rows_left
+                if n_rows is not None and rows_left is not None:
+                    n_rows = min(n_rows, rows_left)
+                data = f.read(-1 if n_rows is None else n_rows * record_length)
+
+                if not data and chunksize is not None:
+                    return
+
+                # the last record may not end with a newline
+                if len(data) % record_length == record_length - 1:
+                    data += b"\n"
+                if len(data) % record_length != 0:
+                    raise ValueError(f"{file_path} does not hold fixed-width records")
+
+                records = np.frombuffer(data, dtype=np.uint8).reshape(-1, record_length)
+                yield to_frame(records)
+
+                if chunksize is None:
+                    return
+                if rows_left is not None:
+                    rows_left -= len(records)
+                    if rows_left <= 0:
+                        return
+
+    if chunksize is None:
+        return next(read_chunks())
+    return read_chunks()
+
+
+def read_fields_raw(file_path, fields, nrows=None, chunksize=None, byte_range=None):
+    """Read select fields from a raw birth record file, fixed-width (see
+    read_fields_fwf) or csv (see read_fields_csv). Byte ranges are only
+    supported for the csvs.
+    """
+    if Path(file_path).suffix == ".dat":
+        if byte_range is not None:
+            raise ValueError(f"{file_path} is fixed-width, and is not split")
+        return read_fields_fwf(file_path, fields, nrows=nrows, chunksize=chunksize)
+
+    return read_fields_csv(
+        file_path, fields, nrows=nrows, chunksize=chunksize, byte_range=byte_range
+    )
+
+
+def extract_fields(file_path, fields, nrows=None, chunksize=None, byte_range=None):
+    """Extract select fields from a birth record csv, in one pass.
+
+    The fields are named as in schema.FIELDS, whatever the year of the csv,
+    and are loaded as compact dtypes (see schema.FIELD_DTYPES). The cached
+    parquet version of the csv (see csv_to_cache) is read if it exists and
+    is current. Fixed-width files (natlYYYY.dat) are read with
+    read_fields_fwf.
+
+    Args:
+        file_path (Path): Path to the birth record csv.
+        fields (list): Fields to extract (e.g. ["dob_yy", "dob_mm"]).
+        nrows (int): Number of rows of the csv to read.
+        chunksize (int): If given, return an iterator of dataframes of
+            this many rows, like pd.read_csv.
+        byte_range (tuple): If given (see split_byte_ranges), only extract
+            the records in this part of the csv. The cache is not used.
+
+    """
+
+    if byte_range is None:
+        cache_path = get_current_cache_path(file_path)
+        if cache_path is not None:
+            return read_fields_cache(
+                cache_path, fields, nrows=nrows, chunksize=chunksize
             )
-            df = df.rename(columns={"state": "state_name_mr"})
-
-            # get state FIPS code and append
-            df = pd.merge(
-                df,
-                df_fips,
-                left_on="state_name_mr",
-                right_on="state_name_mr",
-                how="inner",
-                copy=False,
+
+        if is_cache_stale(file_path):
+            logger = logging.getLogger(__name__)
+            logger.warning(
+                f"{get_cache_path(file_path)} was not made from the current "
+                f"{Path(file_path).name}, so the csv is read instead (run make cache)"
             )
-            df = df.rename(columns={"state_fips": "mrstatefips"})
 
-            # drop any rows with NaN's
-            df = df.dropna()
+    return read_fields_raw(
+        file_path, fields, nrows=nrows, chunksize=chunksize, byte_range=byte_range
+    )
+
 
-        # if the CSVs are of older format
-        else:
+def get_read_size(file_path, byte_range=None):
+    """Get the number of bytes extract_fields reads from disk for a csv."""
+    if byte_range is not None:
+        return byte_range[1] - byte_range[0]
+
+    cache_path = get_current_cache_path(file_path)
+    if cache_path is not None:
+        return cache_path.stat().st_size
+    return Path(file_path).stat().st_size
+
+
+def iter_fields(file_path, fields, nrows=None, chunksize=None, byte_range=None):
+    """Extract select fields from a birth record csv (see extract_fields) as
+    an iterator of dataframes, a single one if no chunksize is given.
 
-            if year >= 1989:
-                col_load, col_rename_dict = col_load_2, col_rename_dict2
+    The reading of each dataframe is recorded as a read stage (see
+    instrument.stage), the first one including the opening of the csv.
+    """
+
+    year = get_year(file_path)
+
+    reader = None
+    while True:
+        with stage("read", year) as record:
+            # the csv is opened (and read, without a chunksize) with the first chunk
+            if reader is None:
+                record["bytes_read"] = get_read_size(file_path, byte_range)
+                reader = extract_fields(
+                    file_path,
+                    fields,
+                    nrows=nrows,
+                    chunksize=chunksize,
+                    byte_range=byte_range,
+                )
+
+                # a single dataframe is returned when no chunksize is given
+                reader = iter([reader] if chunksize is None else reader)
+                first = True
             else:
-                col_load, col_rename_dict = col_load_3, col_rename_dict3
-
-            # load only select columns from the birth CSV
-            df = pd.read_csv(
-                file_path, nrows=nrows, usecols=col_load, dtype=str
-            ).rename(columns=col_rename_dict)
-
-            # rename 'mrstate' column
-            df = df.rename(columns={"mrstate": "mrstatefips"})
-
-            # merge the df_stat_fips to get the full state name
-            df = pd.merge(
-                df,
-                df_fips,
-                left_on="mrstatefips",
-                right_on="state_fips",
-                how="inner",
-                copy=False,
-            ).drop(["state_fips"], axis=1)
-
-            # years before 1989 only show a single digit (i.e. 2 for 1982)
-            if year < 1989:
-                df = df.drop(columns=["dob_yy"])
-                df["dob_yy"] = np.array([year] * df.shape[0])
-
-            # drop any rows with NaN's
-            df = df.dropna()
-
-        # return the dataframe, and order the columns in a fixed manner
-        print(f'{year} processing complete')
-        return df[
-            [
-                "dob_yy",
-                "dob_mm",
-                "mrcntyfips",
-                "mrcityfips",
-                "state_name_mr",
-                "mrstatefips",
-                "apgar5",
-            ]
-        ].astype({"dob_mm": int, "dob_yy": int, "apgar5": int})
+                first = False
 
+            df = next(reader, None)
+            record["rows_out"] = 0 if df is None else len(df)
 
-def df_from_csv_no_geo(file_path, nrows=None):
-    """Extract useful columns from birth record csv
-    Takes a csv path. Produces a dataframe without geo data.
-    Good for all years of data collection.
+            # only an empty csv is recorded when there is nothing left to read
+            record["discard"] = df is None and not first
+
+        if df is None:
+            return
+        yield df
+
+
+# columns returned by df_from_csv_with_geo, in order
+GEO_COLUMNS = [
+    "dob_yy",
+    "dob_mm",
+    "mrcntyfips",
+    "mrcityfips",
+    "state_name_mr",
+    "mrstatefips",
+    "apgar5",
+]
+
+# fields needed from the csv by df_from_csv_with_geo
+GEO_FIELDS = ["dob_yy", "dob_mm", "mrstate", "mrcntyfips", "mrcityfips", "apgar5"]
+
+
+def load_state_fips(folder_external):
+    """Load the FIPS code and name of each state from the geocodes csv."""
+
+    # load FIPS code data
+    df_fips = pd.read_csv(
+        Path(folder_external) / "all-geocodes-v2017.csv", dtype=str
+    )
+
+    # get the fips codes for the states only
+    df_fips = df_fips[
+        (df_fips["County Code (FIPS)"] == "000")
+        & (df_fips["County Subdivision Code (FIPS)"] == "00000")
+        & (df_fips["Place Code (FIPS)"] == "00000")
+        & (df_fips["Consolidtated City Code (FIPS)"] == "00000")
+    ][
+        [
+            "State Code (FIPS)",
+            "Area Name (including legal/statistical area description)",
+        ]
+    ]
+
+    # rename columns in df
+    df_fips.columns = ["state_fips", "state_name_mr"]
+    return df_fips
+
+
+def load_state_abbr(folder_external):
+    """Load the abbreviation of each state, so we can rename AK to Alaska, etc."""
+    return pd.read_csv(
+        Path(folder_external) / "state_abbreviations.csv",
+        header=None,
+        names=["state", "abbr"],
+    )
+
+
+def geo_day_fields(year):
+    """Get the day of birth field of a year. It is loaded with the geo fields
+    so that records missing it are dropped too.
+    """
+    return [f for f in ["dob_wk", "dob_day"] if fields_available(year, [f])]
+
+
+@lru_cache(maxsize=None)
+def load_state_lookup(folder_external):
+    """Build the lookup table of the states from the geocodes and state
+    abbreviation csvs. It is cached, so the csvs are only read once per
+    process (and workers forked after the first call share it).
+
+    Returns a dict with:
+        state_fips (np.ndarray): FIPS code of each state, e.g. "01".
+        state_name (np.ndarray): Name of each state, e.g. "Alabama".
+        fips_index (np.ndarray): Row of the state with each FIPS code (as an
+            int from 0 to 99), or -1 if there is no such state.
+        abbr_index (np.ndarray): Row of the state with each abbreviation
+            (see abbr_to_int), or -1 if there is no such state.
     """
 
-    # get year of CSV
-    year = int(str(file_path).split("/")[-1][4:8])
-    # print(year)
+    df_fips = load_state_fips(folder_external).reset_index(drop=True)
+    df_abbr = load_state_abbr(folder_external)
 
-    # require differnt column names depending on year
-    # columns for 2003+
-    col_load_1 = ["dob_yy", "dob_mm"]
+    fips_index = np.full(100, -1, dtype=np.int16)
+    fips_index[df_fips["state_fips"].astype(int).to_numpy()] = df_fips.index
+
+    # abbreviations of states that are not in the geocodes csv are left out
+    rows = df_fips.reset_index().merge(
+        df_abbr, left_on="state_name_mr", right_on="state", how="inner"
+    )
+    abbr_index = np.full(26 * 26, -1, dtype=np.int16)
+    abbr_index[abbr_to_int(rows["abbr"])] = rows["index"]
 
-    # columns for 1989-2002
-    col_load_2 = ["biryr", "birmon"]
-    rename_col2 = ["dob_yy", "dob_mm"]
+    return {
+        "state_fips": df_fips["state_fips"].to_numpy(),
+        "state_name": df_fips["state_name_mr"].to_numpy(),
+        "fips_index": fips_index,
+        "abbr_index": abbr_index,
+    }
+
+
+def abbr_to_int(abbrs):
+    """Turn two letter state abbreviations (e.g. "AK") into ints from 0 to 675.
+    Anything else is turned into -1.
+    """
+    abbrs = pd.Series(abbrs, dtype=object).astype(str)
+    valid = abbrs.str.fullmatch(r"[A-Z]{2}").to_numpy()
 
-    # columns for 1982 through 1988
-    col_load_3 = ["datayear", "birmon"]
-    rename_col3 = ["dob_yy", "dob_mm"]
+    letters = np.frombuffer(
+        "".join(abbrs[valid]).encode("ascii"), dtype=np.uint8
+    ).reshape(-1, 2).astype(np.int16) - ord("A")
 
-    # create dictionary to rename older csvs
-    col_rename_dict2 = dict(zip(col_load_2, rename_col2))
-    col_rename_dict3 = dict(zip(col_load_3, rename_col3))
+    ints = np.full(len(abbrs), -1, dtype=np.int16)
+    ints[valid] = letters[:, 0] * 26 + letters[:, 1]
+    return ints
 
-    # create dictionary to rename older CSVs from 1991 to 2002
-    col_rename_dict = dict(zip(col_load_2, col_load_1))
 
-    # if the CSVs are of newer format
+def get_state_rows(codes, year, lookup):
+    """Get the row of the state lookup table (see load_state_lookup) of each
+    state code, or -1 for codes that are not a known state.
+
+    The codes are abbreviations from 2003 on, and FIPS codes before.
+    Only the distinct codes are looked up, and then mapped onto the records.
+    """
+
+    codes = pd.Categorical(codes)
+    categories = codes.categories.astype(str)
+
     if year >= 2003:
+        keys = abbr_to_int(categories)
+        index = lookup["abbr_index"]
+    else:
+        # FIPS codes must be written with two digits, e.g. "01"
+        valid = categories.str.fullmatch(r"\d{2}")
+        keys = np.where(valid, categories.where(valid, "-1").astype(int), -1)
+        index = lookup["fips_index"]
 
-        # 2019 and 2020 columns are capitalized
-        if year >= 2019:
-            col_load_1 = [col_name.upper() for col_name in col_load_1]
+    category_rows = np.where(keys >= 0, index[keys], -1)
 
-        # load only select columns, and set dtype for columns
-        df = pd.read_csv(file_path, nrows=nrows, usecols=col_load_1, dtype=str)
+    # records with a missing code (code of -1) take the last entry, -1
+    return np.append(category_rows, -1)[codes.codes]
 
-        df.columns = df.columns.str.lower()
 
-        # drop any rows with NaN's
-        df = df.dropna()
+def add_state_names(df, year, lookup):
+    """Take the geo fields extracted from a birth record csv and
+    return the GEO_COLUMNS, with the state names and FIPS codes.
 
-        df["births"] = np.ones(df.shape[0])
-        df = (
-            df.groupby(["dob_yy", "dob_mm"], as_index=False)
-            .count()
-            .sort_values(by=["dob_yy", "dob_mm"])
-        )
+    The state names and FIPS codes are taken from the state lookup table
+    (see load_state_lookup). Records with an unknown state are dropped.
+    """
 
-    elif year > 1988 and year < 2004:
+    with stage("merge", year, rows_in=len(df)) as record:
+        rows = get_state_rows(df["mrstate"], year, lookup)
+        known = rows >= 0
+        df = df.loc[known].drop(columns=["mrstate"])
+        rows = rows[known]
 
-        # load only select columns from the birth CSV
-        df = pd.read_csv(file_path, nrows=nrows, usecols=col_load_2, dtype=str).rename(
-            columns=col_rename_dict2
+        df["state_name_mr"] = pd.Categorical.from_codes(
+            rows, categories=pd.Index(lookup["state_name"], dtype=object)
         )
+        df["mrstatefips"] = pd.Categorical.from_codes(
+            rows, categories=pd.Index(lookup["state_fips"], dtype=object)
+        )
+        record["rows_out"] = len(df)
 
-        # drop any rows with NaN's
+    # drop any rows with NaN's
+    with stage("dropna", year, rows_in=len(df)) as record:
         df = df.dropna()
+        record["rows_out"] = len(df)
 
-        df["births"] = np.ones(df.shape[0])
-        df = (
-            df.groupby(["dob_yy", "dob_mm"], as_index=False)
-            .count()
-            .sort_values(by=["dob_yy", "dob_mm"])
+    # order the columns in a fixed manner
+    with stage("cast", year, rows_in=len(df)) as record:
+        record["rows_out"] = len(df)
+        return df[GEO_COLUMNS].astype(
+            {"dob_mm": np.uint8, "dob_yy": np.uint16, "apgar5": np.uint8}
         )
 
-    # if the CSVs are of older format
+
+# columns of the county and city level tables (with a births column)
+COUNTY_COLUMNS = [
+    "dob_yy",
+    "dob_mm",
+    "mrstatefips",
+    "state_name_mr",
+    "mrcntyfips",
+    "county_name",
+]
+CITY_COLUMNS = ["dob_yy", "dob_mm", "mrstatefips", "mrcntyfips", "mrcityfips"]
+
+
+def load_county_fips(folder_external):
+    """Load the FIPS code (state and county, e.g. "01001") and name of each
+    county from the geocodes csv.
+    """
+
+    df_fips = pd.read_csv(
+        Path(folder_external) / "all-geocodes-v2017.csv", dtype=str
+    )
+
+    # get the fips codes for the counties only
+    df_fips = df_fips[df_fips["Summary Level"] == "050"]
+
+    return pd.DataFrame(
+        {
+            "county_fips": df_fips["State Code (FIPS)"]
+            + df_fips["County Code (FIPS)"],
+            "county_name": df_fips[
+                "Area Name (including legal/statistical area description)"
+            ],
+        }
+    ).reset_index(drop=True)
+
+
+@lru_cache(maxsize=None)
+def load_county_lookup(folder_external):
+    """Build the lookup table of the counties from the geocodes csv, cached
+    like load_state_lookup.
+
+    Returns a dict with:
+        county_fips (np.ndarray): FIPS code of each county, e.g. "01001".
+        county_name (np.ndarray): Name of each county, e.g. "Autauga County".
+        fips_index (np.ndarray): Row of the county with each FIPS code (as an
+            int from 0 to 99999), or -1 if there is no such county.
+    """
+
+    df_fips = load_county_fips(folder_external)
+
+    fips_index = np.full(100000, -1, dtype=np.int32)
+    fips_index[df_fips["county_fips"].astype(int).to_numpy()] = df_fips.index
+
+    return {
+        "county_fips": df_fips["county_fips"].to_numpy(),
+        "county_name": df_fips["county_name"].to_numpy(),
+        "fips_index": fips_index,
+    }
+
+
+def add_county_fips(df, year):
+    """Replace the county codes of the GEO_COLUMNS (see add_state_names) with
+    the FIPS code of the state and county, e.g. "01001".
+
+    The county code already holds the state before 2003 (e.g. "01001"), but
+    from 2003 on it is only the county, without its leading zeros (e.g. "1").
+    Codes that are not numbers are set to NaN.
+    """
+
+    codes = pd.Categorical(df["mrcntyfips"])
+    categories = pd.to_numeric(
+        pd.Series(codes.categories.astype(str)), errors="coerce"
+    ).to_numpy()
+
+    # the county is the last three digits of the code
+    county = np.append(categories % 1000, np.nan)[codes.codes]
+
+    state = pd.Categorical(df["mrstatefips"])
+    state = np.append(
+        pd.to_numeric(pd.Series(state.categories.astype(str))).to_numpy(), np.nan
+    )[state.codes]
+
+    fips = state * 1000 + county
+    known = ~np.isnan(fips)
+
+    # codes of the distinct counties, mapped onto the records
+    keys, inverse = np.unique(fips[known].astype(np.int32), return_inverse=True)
+    county_codes = np.full(len(df), -1)
+    county_codes[known] = inverse
+
+    df = df.copy()
+    df["mrcntyfips"] = pd.Categorical.from_codes(
+        county_codes, categories=[f"{key:05d}" for key in keys]
+    )
+    return df
+
+
+def add_county_names(df, lookup):
+    """Add the name of each county (a county_name column) to a table with
+    county FIPS codes (see add_county_fips), from the county lookup table
+    (see load_county_lookup).
+
+    Counties that are not in the geocodes csv (e.g. "01999", used for the
+    counties that are not identified in the birth records) have no name.
+    """
+
+    fips = pd.to_numeric(df["mrcntyfips"].astype(str)).to_numpy()
+    rows = lookup["fips_index"][fips]
+    names = np.append(lookup["county_name"], None)[rows]
+
+    return df.assign(county_name=names)
+
+
+def county_counts_to_df(counts_city, state_lookup, county_lookup):
+    """Turn running birth counts by CITY_COLUMNS (see add_birth_counts) into
+    the county and city level tables.
+
+    The counties are counted by summing up their cities, and are only then
+    joined to their state and county names, so the names are not carried
+    along with every record.
+
+    Returns:
+        tuple: (table with the COUNTY_COLUMNS and births,
+            table with the CITY_COLUMNS and births)
+    """
+
+    df_city = birth_counts_to_df(counts_city, CITY_COLUMNS).astype(
+        {
+            "dob_yy": int,
+            "dob_mm": int,
+            "mrstatefips": str,
+            "mrcntyfips": str,
+            "mrcityfips": str,
+            "births": int,
+        }
+    )
+
+    df_county = df_city.groupby(
+        ["dob_yy", "dob_mm", "mrstatefips", "mrcntyfips"], as_index=False
+    )["births"].sum()
+
+    state_rows = state_lookup["fips_index"][df_county["mrstatefips"].astype(int)]
+    df_county["state_name_mr"] = state_lookup["state_name"][state_rows]
+    df_county = add_county_names(df_county, county_lookup)
+
+    return df_county[COUNTY_COLUMNS + ["births"]], df_city
+
+
+def df_from_csv_with_geo(
+    file_path, nrows=None, consolidate=False, chunksize=None, byte_range=None
+):
+    """Extract useful columns from birth record csv
+    Takes a csv path. CSV must be before 2005 to include geo data.
+
+    If consolidate is True, a births column is added holding the number of
+    births for each unique geo, date and apgar5, instead of returning one
+    row per birth. With a chunksize, the csv is read (and consolidated)
+    in chunks of that many rows. With a byte_range (see split_byte_ranges),
+    only that part of the csv is read.
+    """
+
+    year = get_year(file_path)
+
+    # no geo data before 1982 or after 2004
+    if not fields_available(year, GEO_FIELDS):
+        return None
+
+    lookup = load_state_lookup(file_path.parent.parent / "external")
+
+    reader = iter_fields(
+        file_path,
+        GEO_FIELDS + geo_day_fields(year),
+        nrows=nrows,
+        chunksize=chunksize,
+        byte_range=byte_range,
+    )
+
+    df_list = []
+    peak_memory = 0
+    for df in reader:
+        peak_memory = max(peak_memory, df.memory_usage(deep=True).sum())
+        df = add_state_names(df, year, lookup)
+
+        # count the births of each unique geo and date in the chunk
+        if consolidate:
+            df = count_geo_births(df, year)
+
+        df_list.append(df)
+
+    if consolidate:
+        df = merge_birth_counts(df_list, GEO_COLUMNS)
     else:
+        df = pd.concat(df_list, ignore_index=True)
 
-        # load only select columns from the birth CSV
-        df = pd.read_csv(file_path, nrows=nrows, usecols=col_load_3, dtype=str).rename(
-            columns=col_rename_dict3
-        )
+    # return the dataframe
+    log_memory_report(year, peak_memory)
+    print(f'{year} processing complete')
+    return df
 
-        # years before 1989 only show a single digit (i.e. 2 for 1982)
-        df = df.drop(columns=["dob_yy"])
-        df["dob_yy"] = np.array([year] * df.shape[0])
 
-        # drop any rows with NaN's
-        df = df.dropna()
+def count_geo_births(df, year=None):
+    """Count the births of each unique geo, date and apgar5 (the GEO_COLUMNS)
+    in a table made by add_state_names.
+    """
+    with stage("groupby", year, rows_in=len(df)) as record:
+        df = df.groupby(GEO_COLUMNS, as_index=False, observed=True).size()
+        record["rows_out"] = len(df)
+        return df.rename(columns={"size": "births"})
 
-        df["births"] = np.ones(df.shape[0])
+
+def merge_birth_counts(df_list, group_cols):
+    """Merge partial birth counts into a single table of birth counts.
+
+    Args:
+        df_list (list): Dataframes with the group_cols and a births column.
+        group_cols (list): Columns the births were counted by.
+
+    """
+
+    with stage("merge", rows_in=sum(len(df) for df in df_list)) as record:
+        df = pd.concat(df_list, ignore_index=True)
         df = (
-            df.groupby(["dob_yy", "dob_mm"], as_index=False)
-            .count()
+            df.groupby(group_cols, as_index=False, observed=True, dropna=False)["births"]
+            .sum()
             .sort_values(by=["dob_yy", "dob_mm"])
+            .reset_index(drop=True)
         )
+        record["rows_out"] = len(df)
+        return df
 
-    # return the dataframe, and order the columns in a fixed manner
-    print(f'{year} processing complete')
-    return df[["dob_yy", "dob_mm", "births"]].astype(
-        {"dob_mm": int, "dob_yy": int, "births": int}
+
+def add_birth_counts(counts, df, group_cols, year=None):
+    """Add the births in df, grouped by group_cols, to the running
+    counts (a series indexed by group_cols, or None to start counting).
+    Rows with NaN's in the group_cols are not counted.
+    """
+
+    with stage("groupby", year, rows_in=len(df)) as record:
+        chunk_counts = df[group_cols].dropna().groupby(group_cols, observed=True).size()
+        record["rows_out"] = len(chunk_counts)
+
+    if counts is None:
+        return chunk_counts
+
+    with stage("merge", year, rows_in=len(counts) + len(chunk_counts)) as record:
+        counts = counts.add(chunk_counts, fill_value=0)
+        record["rows_out"] = len(counts)
+        return counts
+
+
+def birth_counts_to_df(counts, group_cols):
+    """Turn running birth counts (see add_birth_counts) into a dataframe
+    with the group_cols and a births column.
+    """
+
+    # no chunks were read (e.g. an empty csv)
+    if counts is None:
+        return pd.DataFrame(columns=group_cols + ["births"])
+
+    return (
+        counts.rename("births")
+        .reset_index()
+        .sort_values(by=group_cols)
+        .reset_index(drop=True)
     )
 
 
-def df_from_csv_no_geo_extra(file_path, nrows=None):
-    """Extract useful columns from birth record csv
-    Takes a csv path. Produces a dataframe without geo data.
-    Includes extra columns, such as apgar5, from 1978 onwards.
+def log_memory_report(year, peak_memory):
+    """Log the peak memory (in bytes) of the records held at once for a year,
+    at debug level, so it is only shown when asked for.
     """
+    logger = logging.getLogger(__name__)
+    logger.debug(
+        f"{year} peak memory of loaded records: {peak_memory / 2 ** 20:.1f} MB"
+    )
 
-    # get year of CSV
-    year = int(str(file_path).split("/")[-1][4:8])
-    # print(year)
 
-    # require differnt column names depending on year
-    # columns for 2003+
-    col_load_1 = ["dob_yy", "dob_mm", "apgar5"]
+def count_births(file_path, group_cols, nrows=None, chunksize=None, byte_range=None):
+    """Count the births in a birth record csv, grouped by group_cols.
 
-    # columns for 1989-2002
-    col_load_2 = ["biryr", "birmon", "fmaps"]
-    rename_col2 = ["dob_yy", "dob_mm", "apgar5"]
+    The csv is read in chunks of chunksize rows (all at once if chunksize is None)
+    and the partial counts of each chunk are folded into a running total, so only
+    one chunk needs to be held in memory at a time.
 
-    # columns for 1982 through 1988
-    col_load_3 = ["datayear", "birmon", "fmaps"]
-    rename_col3 = ["dob_yy", "dob_mm", "apgar5"]
+    Args:
+        file_path (Path): Path to the birth record csv.
+        group_cols (list): Fields (see schema.FIELDS) to count the births by.
+        nrows (int): Number of rows of the csv to read.
+        chunksize (int): Number of rows to read per chunk.
+        byte_range (tuple): Part of the csv to read (see split_byte_ranges).
 
-    # create dictionary to rename older csvs
-    col_rename_dict2 = dict(zip(col_load_2, rename_col2))
-    col_rename_dict3 = dict(zip(col_load_3, rename_col3))
+    """
 
-    # create dictionary to rename older CSVs from 1991 to 2002
-    col_rename_dict = dict(zip(col_load_2, col_load_1))
+    year = get_year(file_path)
 
-    # if the CSVs are of newer format
-    if year >= 2003:
+    reader = iter_fields(
+        file_path, group_cols, nrows=nrows, chunksize=chunksize, byte_range=byte_range
+    )
 
-        # 2019 and 2020 columns are capitalized
-        if year >= 2019:
-            col_load_1 = [col_name.upper() for col_name in col_load_1]
+    counts = None
+    peak_memory = 0
+    for df in reader:
+        peak_memory = max(peak_memory, df.memory_usage(deep=True).sum())
+        counts = add_birth_counts(counts, df, group_cols, year=year)
 
-        # load only select columns, and set dtype for columns
-        df = pd.read_csv(file_path, nrows=nrows, usecols=col_load_1, dtype=str)
-        df.columns = df.columns.str.lower()
+    log_memory_report(year, peak_memory)
+    return birth_counts_to_df(counts, group_cols)
 
-        # drop any rows with NaN's
-        df = df.dropna()
 
-        df["births"] = np.ones(df.shape[0])
-        df = (
-            df.groupby(["dob_yy", "dob_mm", "apgar5"], as_index=False)
-            .count()
-            .sort_values(by=["dob_yy", "dob_mm", "apgar5"])
-        )
+def df_from_csv_no_geo(file_path, nrows=None, chunksize=None, byte_range=None):
+    """Extract useful columns from birth record csv
+    Takes a csv path. Produces a dataframe without geo data.
+    Good for all years of data collection.
 
-    elif year > 1988 and year < 2004:
+    If chunksize is given, the csv is streamed in chunks of that many rows
+    so that only a small part of it is ever in memory. With a byte_range
+    (see split_byte_ranges), only that part of the csv is read.
+    """
 
-        # load only select columns from the birth CSV
-        df = pd.read_csv(file_path, nrows=nrows, usecols=col_load_2, dtype=str).rename(
-            columns=col_rename_dict2
-        )
+    year = get_year(file_path)
 
-        # drop any rows with NaN's
-        df = df.dropna()
+    df = count_births(
+        file_path,
+        ["dob_yy", "dob_mm"],
+        nrows=nrows,
+        chunksize=chunksize,
+        byte_range=byte_range,
+    )
 
-        df["births"] = np.ones(df.shape[0])
-        df = (
-            df.groupby(["dob_yy", "dob_mm", "apgar5"], as_index=False)
-            .count()
-            .sort_values(by=["dob_yy", "dob_mm", "apgar5"])
-        )
+    # return the dataframe, and order the columns in a fixed manner
+    print(f'{year} processing complete')
+    return df[["dob_yy", "dob_mm", "births"]].astype(
+        {"dob_mm": int, "dob_yy": int, "births": int}
+    )
 
-    # if the CSVs are of older format
-    elif year > 1977 and year <= 1988:
 
-        # load only select columns from the birth CSV
-        df = pd.read_csv(file_path, nrows=nrows, usecols=col_load_3, dtype=str).rename(
-            columns=col_rename_dict3
-        )
+def df_from_csv_no_geo_extra(file_path, nrows=None, chunksize=None, byte_range=None):
+    """Extract useful columns from birth record csv
+    Takes a csv path. Produces a dataframe without geo data.
+    Includes extra columns, such as apgar5, from 1978 onwards.
 
-        # years before 1989 only show a single digit (i.e. 2 for 1982)
-        df = df.drop(columns=["dob_yy"])
-        df["dob_yy"] = np.array([year] * df.shape[0])
+    If chunksize is given, the csv is streamed in chunks of that many rows
+    so that only a small part of it is ever in memory. With a byte_range
+    (see split_byte_ranges), only that part of the csv is read.
+    """
 
-        # drop any rows with NaN's
-        df = df.dropna()
+    year = get_year(file_path)
 
-        df["births"] = np.ones(df.shape[0])
-        df = (
-            df.groupby(["dob_yy", "dob_mm", "apgar5"], as_index=False)
-            .count()
-            .sort_values(by=["dob_yy", "dob_mm", "apgar5"])
-        )
     # if the csvs are older than 1978 they do not have relevant cols
     # like apgar, and thus we skip them
+    if fields_available(year, ["apgar5"]):
+        df = count_births(
+            file_path,
+            ["dob_yy", "dob_mm", "apgar5"],
+            nrows=nrows,
+            chunksize=chunksize,
+            byte_range=byte_range,
+        )
     else:
         df = pd.DataFrame(columns=["dob_yy", "dob_mm", "apgar5", "births"])
 
@@ -388,45 +1113,181 @@ def df_from_csv_no_geo_extra(file_path, nrows=None):
         {"dob_mm": int, "dob_yy": int, "apgar5": int, "births": int}
     )
 
+
+def df_from_csv_all(
+    file_path, nrows=None, chunksize=None, per_birth=False, byte_range=None
+):
+    """Extract every processed table from a birth record csv, reading it once.
+
+    The union of the fields needed by df_from_csv_no_geo,
+    df_from_csv_no_geo_extra and df_from_csv_with_geo is loaded, and each
+    chunk is fanned out into the three tables. For years with geo data, the
+    births are also counted by county and city.
+
+    Args:
+        file_path (Path): Path to the birth record csv.
+        nrows (int): Number of rows of the csv to read.
+        chunksize (int): Number of rows to read per chunk.
+        per_birth (bool): Also return the per-birth geo table.
+        byte_range (tuple): Part of the csv to read (see split_byte_ranges).
+            The tables of the parts of a csv are merged with merge_table_parts.
+
+    Returns:
+        dict: The dataframes of the year, keyed by the name of the processed
+            table they belong to ("births_simple", "births_simple_with_apgar",
+            "births_with_geo_apgar_consolidated", "births_with_geo_apgar",
+            "births_by_county" and "births_by_city").
+            The geo tables are None for years without geo data.
+    """
+
+    year = get_year(file_path)
+
+    has_apgar = fields_available(year, ["apgar5"])
+    has_geo = fields_available(year, GEO_FIELDS)
+
+    fields = ["dob_yy", "dob_mm"]
+    if has_apgar:
+        fields = fields + ["apgar5"]
+    if has_geo:
+        fields = GEO_FIELDS + geo_day_fields(year)
+        lookup = load_state_lookup(file_path.parent.parent / "external")
+        county_lookup = load_county_lookup(file_path.parent.parent / "external")
+
+    reader = iter_fields(
+        file_path, fields, nrows=nrows, chunksize=chunksize, byte_range=byte_range
+    )
+
+    counts_simple = None
+    counts_apgar = None
+    counts_city = None
+    geo_list = []
+    peak_memory = 0
+    for df in reader:
+        peak_memory = max(peak_memory, df.memory_usage(deep=True).sum())
+        counts_simple = add_birth_counts(
+            counts_simple, df, ["dob_yy", "dob_mm"], year=year
+        )
+
+        if has_apgar:
+            counts_apgar = add_birth_counts(
+                counts_apgar, df, ["dob_yy", "dob_mm", "apgar5"], year=year
+            )
+
+        if has_geo:
+            df = add_state_names(df, year, lookup)
+            counts_city = add_birth_counts(
+                counts_city, add_county_fips(df, year), CITY_COLUMNS, year=year
+            )
+
+            if not per_birth:
+                df = count_geo_births(df, year)
+            geo_list.append(df)
+
+    tables = {
+        "births_simple": birth_counts_to_df(
+            counts_simple, ["dob_yy", "dob_mm"]
+        ).astype({"dob_mm": int, "dob_yy": int, "births": int}),
+        "births_simple_with_apgar": birth_counts_to_df(
+            counts_apgar, ["dob_yy", "dob_mm", "apgar5"]
+        ).astype({"dob_mm": int, "dob_yy": int, "apgar5": int, "births": int}),
+        "births_with_geo_apgar_consolidated": None,
+        "births_with_geo_apgar": None,
+        "births_by_county": None,
+        "births_by_city": None,
+    }
+
+    if has_geo:
+        if per_birth:
+            df = pd.concat(geo_list, ignore_index=True)
+            tables["births_with_geo_apgar"] = df
+            geo_list = [count_geo_births(df, year)]
+
+        tables["births_with_geo_apgar_consolidated"] = merge_birth_counts(
+            geo_list, GEO_COLUMNS
+        )
+
+        (
+            tables["births_by_county"],
+            tables["births_by_city"],
+        ) = county_counts_to_df(counts_city, lookup, county_lookup)
+
+    log_memory_report(year, peak_memory)
+    print(f'{year} processing complete')
+    return tables
+
+
+def merge_table_parts(tables_list):
+    """Merge the tables made by df_from_csv_all from each part of a csv
+    (see split_byte_ranges), given in the order of the parts.
+    """
+
+    group_cols = {
+        "births_simple": ["dob_yy", "dob_mm"],
+        "births_simple_with_apgar": ["dob_yy", "dob_mm", "apgar5"],
+        "births_with_geo_apgar_consolidated": GEO_COLUMNS,
+        "births_by_county": COUNTY_COLUMNS,
+        "births_by_city": CITY_COLUMNS,
+    }
+
+    tables = {}
+    for table_name in tables_list[0]:
+        df_list = [tables[table_name] for tables in tables_list]
+
+        # the geo tables are None for years without geo data
+        if df_list[0] is None:
+            tables[table_name] = None
+        elif table_name in group_cols:
+            tables[table_name] = merge_birth_counts(df_list, group_cols[table_name])
+        else:
+            tables[table_name] = pd.concat(df_list, ignore_index=True)
+
+    return tables
+
 ###############################################################################
 # Functions for processing the collated data files and returning a dataframe
 ###############################################################################
 
-def get_month_string(cols):
-    month_index = int(cols[0])
-
-    # from https://stackoverflow.com/a/28446432/9214620
-    return datetime.date(1900, month_index, 1).strftime("%B")
+# full month names, indexed by month - 1
+MONTH_NAMES = np.array(
+    [datetime.date(1900, month_index, 1).strftime("%B") for month_index in range(1, 13)],
+    dtype=object,
+)
 
 
-def get_conception_month(cols):
-    month_index = int(cols[0])
-    concept_date = datetime.date(1900, month_index, 1) + relativedelta(months=-9)
+def add_conception_dates(df, gestation_months=9):
+    """Add the conception month and year, and the birth month name, to df.
 
-    return concept_date.strftime("%B")
+    The conception date is found with integer month arithmetic on the whole
+    columns at once, rather than building a date for each row.
 
+    Args:
+        df (pd.DataFrame): Requires columns: dob_yy, dob_mm.
+        gestation_months (int): Number of months between conception and birth.
 
-def get_conception_year(cols):
-    month_index = int(cols[0])
-    year = int(cols[1])
-    concept_date = datetime.date(year, month_index, 1) + relativedelta(months=-9)
-
-    return int(concept_date.strftime("%Y"))
+    Adds the columns conc_month, birth_month, conc_mm and conc_yy.
+    """
 
+    dob_mm = df["dob_mm"].to_numpy(dtype=int)
+    dob_yy = df["dob_yy"].to_numpy(dtype=int)
 
-def get_conception_month_index(cols):
-    month_index = int(cols[0])
-    concept_date = datetime.date(1900, month_index, 1) + relativedelta(months=-9)
+    # count months from year 0 so that going back crosses years correctly
+    conc_index = dob_yy * 12 + (dob_mm - 1) - gestation_months
+    conc_mm = conc_index % 12 + 1
+    conc_yy = conc_index // 12
 
-    return int(concept_date.strftime("%m"))
+    df["conc_month"] = MONTH_NAMES[conc_mm - 1]
+    df["birth_month"] = MONTH_NAMES[dob_mm - 1]
+    df["conc_mm"] = conc_mm
+    df["conc_yy"] = conc_yy
+    return df
 
 
-def df_birth_no_geo_prep(df):
+def df_birth_no_geo_prep(df, gestation_months=9):
     """Prepare the birth data for analysis.
 
     Args:
         df (pd.DataFrame): The raw birth data. Requires columns: dob_yy, dob_mm, births.
-        filter_year (int): The year to filter the data to.
+        gestation_months (int): Number of months between conception and birth.
 
     """
 
@@ -434,10 +1295,7 @@ def df_birth_no_geo_prep(df):
     # df = pd.read_csv(data_file, dtype=int).sort_values(by=['dob_yy', 'dob_mm', 'dob_wk'])
 
     # add conception month columns and birth month
-    df["conc_month"] = df[["dob_mm"]].apply(get_conception_month, axis=1)
-    df["birth_month"] = df[["dob_mm"]].apply(get_month_string, axis=1)
-    df["conc_mm"] = df[["dob_mm"]].apply(get_conception_month_index, axis=1)
-    df["conc_yy"] = df[["dob_mm", "dob_yy"]].apply(get_conception_year, axis=1)
+    df = add_conception_dates(df, gestation_months=gestation_months)
     df = df.sort_values(by=["conc_yy", "conc_mm"])
 
     return df[
@@ -453,7 +1311,7 @@ def df_birth_no_geo_prep(df):
     ]
 
 
-def df_birth_with_geo_prep(df, df_abbr):
+def df_birth_with_geo_prep(df, df_abbr, gestation_months=9):
      
      
     df = pd.merge(df, df_abbr, 
@@ -469,20 +1327,112 @@ def df_birth_with_geo_prep(df, df_abbr):
                                               'state_name_mr']).drop(columns=['mrcntyfips'])
     
     # add conception month columns and birth month
-    df['conc_month'] = df[['dob_mm']].apply(get_conception_month, axis=1)
-    df['birth_month'] = df[['dob_mm']].apply(get_month_string, axis=1)
-    df['conc_mm'] = df[['dob_mm']].apply(get_conception_month_index, axis=1)
-    df['conc_yy'] = df[['dob_mm', 'dob_yy']].apply(get_conception_year, axis=1)
+    df = add_conception_dates(df, gestation_months=gestation_months)
 
     return df[['dob_yy', 'dob_mm', 'state_name_mr', 
                'mrstatefips', 'abbr', 'conc_month', 
                'birth_month', 'conc_mm', 'conc_yy', 'births']]
 
 
+# columns of the prepared birth data that births are summed over
+BIRTH_MONTH_COLUMNS = [
+    "conc_yy",
+    "conc_month",
+    "dob_yy",
+    "birth_month",
+    "conc_mm",
+    "dob_mm",
+]
+
+
+def make_birth_cube(df, extra_cols=None):
+    """Aggregate the prepared birth data once into a cube of birth counts
+    that can be sliced by birth or conception year without regrouping.
+
+    Args:
+        df (pd.DataFrame): The prepared birth data (created using
+            df_birth_no_geo_prep or df_birth_with_geo_prep).
+        extra_cols (list): Other columns to keep in the cube, such as
+            ["abbr"] for states or ["apgar5"].
+
+    Returns:
+        dict: The cube. "dob_yy" and "conc_yy" hold the birth counts indexed
+            by birth year and month, or conception year and month, with
+            sorted indexes. "national" holds the births of each month summed
+            over the extra_cols, sorted by birth date.
+    """
+
+    if extra_cols is None:
+        extra_cols = []
+
+    group_cols = BIRTH_MONTH_COLUMNS + list(extra_cols)
+    df = df.groupby(group_cols, as_index=False)["births"].sum()
+
+    cube = {"extra_cols": list(extra_cols)}
+    for filter_cat, month_col in [("dob_yy", "dob_mm"), ("conc_yy", "conc_mm")]:
+        # the extra_cols come right after the year and month, so that they
+        # are looked up in the sorted index as well (see query_birth_cube)
+        index_cols = (
+            [filter_cat, month_col]
+            + list(extra_cols)
+            + [c for c in BIRTH_MONTH_COLUMNS if c not in (filter_cat, month_col)]
+        )
+        cube[filter_cat] = df.set_index(index_cols).sort_index()
+
+    if extra_cols:
+        df = df.groupby(BIRTH_MONTH_COLUMNS, as_index=False)["births"].sum()
+    cube["national"] = df.sort_values(by=["dob_yy", "dob_mm"]).reset_index(drop=True)
+
+    return cube
+
+
+def query_birth_cube(cube, filter_cat="dob_yy", year=None, months=None, **values):
+    """Slice the birth counts out of a cube (see make_birth_cube).
+
+    Args:
+        cube (dict): The cube, created using make_birth_cube.
+        filter_cat (str): Slice by birth year ('dob_yy') or conception
+            year ('conc_yy').
+        year (int): The year to slice. All years if None.
+        months (tuple): First and last month (inclusive) to slice, e.g. (3, 6).
+        **values: Values of the extra_cols of the cube to select, e.g. abbr="CA".
+            They are looked up in the sorted index, like the year and months.
+
+    """
+
+    df = cube[filter_cat]
+
+    unknown = [col_name for col_name in values if col_name not in cube["extra_cols"]]
+    if unknown:
+        raise KeyError(f"{unknown} are not extra_cols of the cube")
+
+    # a slice for each level of the index, in order
+    level_slices = {name: slice(None) for name in df.index.names}
+    if year is not None:
+        level_slices[df.index.names[0]] = slice(year, year)
+    if months is not None:
+        level_slices[df.index.names[1]] = slice(months[0], months[1])
+    for col_name, value in values.items():
+        level_slices[col_name] = slice(value, value)
+
+    # the index is sorted, so each level is a binary search rather than a scan
+    df = df.loc[tuple(level_slices[name] for name in df.index.names), :]
+
+    return df.reset_index()[BIRTH_MONTH_COLUMNS + cube["extra_cols"] + ["births"]]
+
+
 def filter_by_year(df, filter_cat="conc_yy", year=1990):
     """Filter df by year, either with conception year ('conc_yy')
     or birth year ('dob_yy')
+
+    df may also be a cube created with make_birth_cube, which is sliced
+    instead of regrouping the whole of df.
     """
+
+    if isinstance(df, dict):
+        df = query_birth_cube(df, filter_cat=filter_cat, year=year)
+        df = df[BIRTH_MONTH_COLUMNS + ["births"]]
+
     df = (
         df[df[filter_cat] == year]
         .groupby(
@@ -506,6 +1456,15 @@ def filter_by_year(df, filter_cat="conc_yy", year=1990):
         return df
 
 
+# number of months in the rolling average births are compared with
+BASELINE_MONTHS = 12
+
+
+def get_month_index(df):
+    """Count the months of the dob_yy and dob_mm columns from year 0."""
+    return df["dob_yy"].to_numpy(dtype=int) * 12 + df["dob_mm"].to_numpy(dtype=int) - 1
+
+
 def percentage_birts_by_month(df, years_greater_than=1980):
     """Take the prepared df and calculage the average births (avg_births)
     and percent above average (percent_above_average) for each month.
@@ -514,21 +1473,226 @@ def percentage_birts_by_month(df, years_greater_than=1980):
         df (pd.DataFrame): The prepared birth data (created using df_birth_no_geo_prep). 
             Requires columns: "conc_yy", "conc_month", "dob_yy", "birth_month", 
             "conc_mm", "dob_mm", "births",
+            May also be a cube created with make_birth_cube.
         years_greater_than (int): Only include data from above this year.
 
     """
-    # group by month
-    df = df.groupby([
-        'conc_yy', 'conc_month','dob_yy',
-        'birth_month','conc_mm','dob_mm',], as_index=False).sum()
-
-    df = df.sort_values(by=['dob_yy','dob_mm']).reset_index(drop=True)
+    if isinstance(df, dict):
+        # the cube is already grouped by month
+        df = df["national"].copy()
 
-    # add 12 month rolling average
-    df['avg_births'] = df['births'].rolling(window=12).mean() 
+    else:
+        # group by month
+        df = df.groupby([
+            'conc_yy', 'conc_month','dob_yy',
+            'birth_month','conc_mm','dob_mm',], as_index=False).sum()
+
+        df = df.sort_values(by=['dob_yy','dob_mm']).reset_index(drop=True)
+
+    # no months (e.g. a filter matching nothing) have no averages
+    if df.empty:
+        return df.assign(avg_births=pd.Series(dtype=float),
+                         percent_above_avg=pd.Series(dtype=float))
+
+    # add 12 month rolling average, over the calendar months, so that a
+    # missing month leaves a gap in the average rather than shifting it
+    month_index = get_month_index(df)
+    births = pd.Series(df["births"].to_numpy(dtype=float), index=month_index)
+    avg_births = (
+        births.reindex(np.arange(month_index.min(), month_index.max() + 1))
+        .rolling(window=BASELINE_MONTHS)
+        .mean()
+    )
+    df['avg_births'] = avg_births.reindex(month_index).to_numpy()
     df['percent_above_avg'] = (df['births'] - df['avg_births'])/df['avg_births']*100
 
     # only select dates > years_greater_than
     df = df[df['dob_yy'] > years_greater_than]
 
     return df
+
+
+def percentage_births_by_month_grouped(df, group_cols=("abbr",), years_greater_than=1980):
+    """Calculate the average births (avg_births) and percent above average
+    (percent_above_avg) of each month, like percentage_birts_by_month, but
+    for every state (or county) at once.
+
+    The births are laid out in a table of months by groups, so the rolling
+    averages of all the groups are taken in a single pass, instead of
+    filtering and grouping the data once per group. As in
+    percentage_birts_by_month, the average is over the calendar months, so
+    a month missing from a group leaves a gap in its average.
+
+    Args:
+        df (pd.DataFrame): Births by month and group, e.g. the output of
+            df_birth_with_geo_prep, or births_by_county.csv.gz. Requires
+            columns: dob_yy, dob_mm, births and the group_cols.
+        group_cols (list): Columns to group by, e.g. ["abbr"] for the states,
+            or ["mrstatefips", "mrcntyfips"] for the counties. Other columns
+            that are fixed for a group (e.g. "state_name_mr") may be added,
+            to be kept in the result.
+        years_greater_than (int): Only include data from above this year.
+
+    Returns:
+        pd.DataFrame: A row per group and month, with the columns group_cols,
+            dob_yy, dob_mm, birth_month, births, avg_births and
+            percent_above_avg, sorted by group and date.
+    """
+
+    group_cols = list(group_cols)
+    df = df.groupby(group_cols + ["dob_yy", "dob_mm"], as_index=False, observed=True)[
+        "births"
+    ].sum()
+
+    columns = group_cols + [
+        "dob_yy",
+        "dob_mm",
+        "birth_month",
+        "births",
+        "avg_births",
+        "percent_above_avg",
+    ]
+
+    # no months (e.g. a filter matching nothing) have no averages
+    if df.empty:
+        return df.assign(
+            birth_month=pd.Series(dtype=object),
+            avg_births=pd.Series(dtype=float),
+            percent_above_avg=pd.Series(dtype=float),
+        )[columns]
+
+    df["month_index"] = get_month_index(df)
+
+    # a column of births per group, and a row per month (with the missing
+    # months as NaN), so that rolling averages every group at once
+    births = df.set_index(["month_index"] + group_cols)["births"].unstack(group_cols)
+    months = np.arange(births.index.min(), births.index.max() + 1)
+    avg_births = (
+        births.reindex(months).astype(float).rolling(window=BASELINE_MONTHS).mean()
+    )
+
+    # look up the average of each group and month
+    if len(group_cols) == 1:
+        group_keys = df[group_cols[0]]
+    else:
+        group_keys = pd.MultiIndex.from_frame(df[group_cols])
+    df["avg_births"] = avg_births.to_numpy()[
+        df["month_index"].to_numpy() - months[0],
+        avg_births.columns.get_indexer(group_keys),
+    ]
+    df["percent_above_avg"] = (df["births"] - df["avg_births"]) / df["avg_births"] * 100
+    df["birth_month"] = MONTH_NAMES[df["dob_mm"].to_numpy(dtype=int) - 1]
+
+    # only select dates > years_greater_than
+    df = df[df["dob_yy"] > years_greater_than]
+
+    return df.sort_values(by=group_cols + ["dob_yy", "dob_mm"]).reset_index(drop=True)[
+        columns
+    ]
+
+
+def make_birth_baseline(df=None):
+    """Start an incremental rolling baseline of the births by month, which
+    gives the same avg_births and percent_above_avg as
+    percentage_birts_by_month as months are appended, without going back
+    over the earlier months (see append_birth_months).
+
+    Only the births of the trailing BASELINE_MONTHS calendar months are
+    kept, in a slot per calendar month, along with their running sum.
+
+    Args:
+        df (pd.DataFrame): Monthly births to start from, e.g. births_simple.csv
+            or the output of percentage_birts_by_month. Requires columns:
+            dob_yy, dob_mm, births.
+
+    Returns:
+        dict: The baseline.
+    """
+
+    baseline = {
+        "last_month": None,
+        "births": np.full(BASELINE_MONTHS, np.nan),
+        "total": 0.0,
+        "count": 0,
+    }
+
+    if df is not None and len(df) > 0:
+        df = df.assign(month_index=get_month_index(df)).sort_values(by="month_index")
+
+        # only the trailing months are needed to carry on from df
+        df = df[df["month_index"] > df["month_index"].max() - BASELINE_MONTHS]
+        append_birth_months(baseline, df)
+
+    return baseline
+
+
+def update_birth_baseline(baseline, month_index, births):
+    """Add the births of a month to the baseline (see make_birth_baseline),
+    in O(1).
+
+    Months missing between the last month and this one are left out of the
+    average, which is NaN until there are BASELINE_MONTHS months of births
+    in the window again.
+
+    Args:
+        baseline (dict): The baseline, updated in place.
+        month_index (int): The month, counted from year 0 (see get_month_index).
+        births (float): Number of births in the month.
+
+    Returns:
+        float: The average births of the month's trailing window (avg_births).
+    """
+
+    slots = baseline["births"]
+    last_month = baseline["last_month"]
+
+    if last_month is not None and month_index <= last_month:
+        raise ValueError(
+            f"Months must be appended in order: month {month_index} is not "
+            f"after the last month, {last_month}"
+        )
+
+    # empty the slots of the missing months, and of the month leaving the window
+    if last_month is None:
+        first_cleared = month_index
+    else:
+        first_cleared = max(last_month + 1, month_index - BASELINE_MONTHS + 1)
+    for month in range(first_cleared, month_index + 1):
+        slot = month % BASELINE_MONTHS
+        if not np.isnan(slots[slot]):
+            baseline["total"] -= slots[slot]
+            baseline["count"] -= 1
+            slots[slot] = np.nan
+
+    slots[month_index % BASELINE_MONTHS] = births
+    baseline["total"] += births
+    baseline["count"] += 1
+    baseline["last_month"] = month_index
+
+    if baseline["count"] < BASELINE_MONTHS:
+        return np.nan
+    return baseline["total"] / BASELINE_MONTHS
+
+
+def append_birth_months(baseline, df):
+    """Append new months of births to a baseline (see make_birth_baseline),
+    and return them with their avg_births and percent_above_avg.
+
+    Args:
+        baseline (dict): The baseline, updated in place.
+        df (pd.DataFrame): The new months, after the last month of the
+            baseline. Requires columns: dob_yy, dob_mm, births.
+
+    """
+
+    df = df.sort_values(by=["dob_yy", "dob_mm"]).reset_index(drop=True)
+
+    df["avg_births"] = [
+        update_birth_baseline(baseline, month_index, births)
+        for month_index, births in zip(
+            get_month_index(df), df["births"].to_numpy(dtype=float)
+        )
+    ]
+    df["percent_above_avg"] = (df["births"] - df["avg_births"]) / df["avg_births"] * 100
+
+    return df
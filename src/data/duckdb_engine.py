@@ -0,0 +1,258 @@
+"""DuckDB engine for extracting and counting the births in the raw csvs.
+
+The readers here return the same dataframes as those of data_prep_utils
+(the pandas engine), but the csvs are scanned, joined with the state
+lookup table and grouped by an embedded DuckDB database, in this process
+(no server is needed). DuckDB reads a single csv on every core, and spills
+to disk (data/interim/duckdb) instead of running out of memory, so the
+csvs are read one at a time rather than a year per worker.
+
+DuckDB is optional, and only imported when this engine is used (see
+engines.py). Zip archives and fixed-width files are read with the pandas
+engine, as DuckDB does not read them.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.data import data_prep_utils
+from src.data.data_prep_utils import (
+    get_current_cache_path,
+    load_state_lookup,
+    geo_day_fields,
+    log_memory_report,
+    GEO_COLUMNS,
+    GEO_FIELDS,
+)
+from src.data.schema import (
+    get_year,
+    get_schema,
+    fields_available,
+    resolve_columns,
+    FIELD_DTYPES,
+)
+
+# SQL types of the dtypes the fields are loaded as (see schema.FIELD_DTYPES)
+SQL_TYPES = {"UInt8": "UTINYINT", "UInt16": "USMALLINT", "category": "VARCHAR"}
+
+
+def connect(file_path, threads=None):
+    """Open an in-memory DuckDB database to process a raw csv with.
+
+    Args:
+        file_path (Path): Path to the birth record csv. Data that does not
+            fit in memory is spilled to data/interim/duckdb, next to data/raw.
+        threads (int): Number of threads to use (default: one per core).
+
+    """
+    import duckdb
+
+    temp_directory = Path(file_path).parent.parent / "interim" / "duckdb"
+    temp_directory.mkdir(parents=True, exist_ok=True)
+
+    config = {
+        "temp_directory": str(temp_directory),
+        # the order of the records does not matter, and keeping it takes memory
+        "preserve_insertion_order": False,
+    }
+    if threads is not None:
+        config["threads"] = threads
+
+    return duckdb.connect(config=config)
+
+
+def quote_path(file_path):
+    """Quote a path as an SQL string literal."""
+    return "'" + str(file_path).replace("'", "''") + "'"
+
+
+def select_fields(file_path, fields, nrows=None):
+    """Get the SQL query selecting fields (see schema.FIELDS) from a birth
+    record csv, or from its parquet cache (see csv_to_cache) if it exists and
+    was made from the csv as it is now.
+
+    The fields are named and typed like the ones extract_fields loads, with
+    codes as strings (keeping their leading zeros). Numbers that cannot be
+    read are NULL.
+    """
+
+    year = get_year(file_path)
+    cache_path = get_current_cache_path(file_path)
+
+    if cache_path is not None:
+        columns = {field: field for field in fields}
+        source = f"read_parquet({quote_path(cache_path)})"
+    else:
+        columns = resolve_columns(year, fields)
+        source = f"read_csv({quote_path(file_path)}, header = true, all_varchar = true)"
+
+    expressions = []
+    for field, column in columns.items():
+        # years before 1989 only show a single digit (i.e. 2 for 1982)
+        if (
+            field == "dob_yy"
+            and cache_path is None
+            and get_schema(year).get("single_digit_year", False)
+        ):
+            expressions.append(f"CAST({year} AS USMALLINT) AS {field}")
+        else:
+            sql_type = SQL_TYPES[FIELD_DTYPES[field]]
+            expressions.append(
+                f'TRY_CAST(CAST("{column}" AS VARCHAR) AS {sql_type}) AS {field}'
+            )
+
+    query = f"SELECT {', '.join(expressions)} FROM {source}"
+    if nrows is not None:
+        query += f" LIMIT {int(nrows)}"
+    return query
+
+
+def uses_pandas(file_path):
+    """Check if a raw file can only be read with the pandas engine (zip
+    archives and fixed-width files, unless they have a current parquet cache).
+    """
+    if Path(file_path).suffix == ".csv":
+        return False
+    return get_current_cache_path(file_path) is None
+
+
+def count_births(file_path, group_cols, nrows=None, threads=None):
+    """Count the births in a birth record csv, grouped by group_cols, like
+    data_prep_utils.count_births. Rows with NULLs in the group_cols are
+    not counted.
+    """
+
+    cols = ", ".join(group_cols)
+    not_null = " AND ".join(f"{col} IS NOT NULL" for col in group_cols)
+    query = (
+        f"SELECT {cols}, count(*) AS births "
+        f"FROM ({select_fields(file_path, group_cols, nrows=nrows)}) "
+        f"WHERE {not_null} GROUP BY {cols} ORDER BY {cols}"
+    )
+
+    with connect(file_path, threads=threads) as con:
+        return con.execute(query).df()
+
+
+def df_from_csv_no_geo(file_path, nrows=None, threads=None):
+    """Count the births in a birth record csv by year and month, like
+    data_prep_utils.df_from_csv_no_geo.
+    """
+
+    if uses_pandas(file_path):
+        return data_prep_utils.df_from_csv_no_geo(file_path, nrows=nrows)
+
+    year = get_year(file_path)
+    df = count_births(file_path, ["dob_yy", "dob_mm"], nrows=nrows, threads=threads)
+
+    print(f'{year} processing complete')
+    return df[["dob_yy", "dob_mm", "births"]].astype(
+        {"dob_mm": int, "dob_yy": int, "births": int}
+    )
+
+
+def df_from_csv_no_geo_extra(file_path, nrows=None, threads=None):
+    """Count the births in a birth record csv by year, month and apgar5,
+    like data_prep_utils.df_from_csv_no_geo_extra.
+    """
+
+    if uses_pandas(file_path):
+        return data_prep_utils.df_from_csv_no_geo_extra(file_path, nrows=nrows)
+
+    year = get_year(file_path)
+
+    # if the csvs are older than 1978 they do not have relevant cols
+    # like apgar, and thus we skip them
+    if fields_available(year, ["apgar5"]):
+        df = count_births(
+            file_path, ["dob_yy", "dob_mm", "apgar5"], nrows=nrows, threads=threads
+        )
+    else:
+        df = pd.DataFrame(columns=["dob_yy", "dob_mm", "apgar5", "births"])
+
+    print(f'{year} processing complete')
+    return df[["dob_yy", "dob_mm", "apgar5", "births"]].astype(
+        {"dob_mm": int, "dob_yy": int, "apgar5": int, "births": int}
+    )
+
+
+def get_state_table(year, lookup):
+    """Get the state lookup table (see load_state_lookup) as a dataframe,
+    keyed by the code of the states in a year's csv: the abbreviation from
+    2003 on, and the two digit FIPS code before.
+    """
+
+    if year >= 2003:
+        abbr_ints = np.flatnonzero(lookup["abbr_index"] >= 0)
+        rows = lookup["abbr_index"][abbr_ints]
+        codes = [chr(ord("A") + i // 26) + chr(ord("A") + i % 26) for i in abbr_ints]
+    else:
+        rows = np.arange(len(lookup["state_fips"]))
+        codes = list(lookup["state_fips"])
+
+    return pd.DataFrame(
+        {
+            "code": codes,
+            "state_name_mr": lookup["state_name"][rows],
+            "mrstatefips": lookup["state_fips"][rows],
+        }
+    )
+
+
+def df_from_csv_with_geo(file_path, nrows=None, consolidate=False, threads=None):
+    """Extract the geo data of a birth record csv, like
+    data_prep_utils.df_from_csv_with_geo. The states are joined on in the
+    database, and with consolidate, so are the birth counts.
+    """
+
+    if uses_pandas(file_path):
+        return data_prep_utils.df_from_csv_with_geo(
+            file_path, nrows=nrows, consolidate=consolidate
+        )
+
+    year = get_year(file_path)
+
+    # no geo data before 1982 or after 2004
+    if not fields_available(year, GEO_FIELDS):
+        return None
+
+    lookup = load_state_lookup(file_path.parent.parent / "external")
+    fields = GEO_FIELDS + geo_day_fields(year)
+
+    # records with an unknown state, or with missing fields, are dropped
+    columns = ", ".join(
+        f"s.{col}" if col in ["state_name_mr", "mrstatefips"] else f"b.{col}"
+        for col in GEO_COLUMNS
+    )
+    not_null = " AND ".join(f"b.{field} IS NOT NULL" for field in fields)
+    query = (
+        f"SELECT {columns} "
+        f"FROM ({select_fields(file_path, fields, nrows=nrows)}) AS b "
+        f"JOIN states AS s ON b.mrstate = s.code "
+        f"WHERE {not_null}"
+    )
+
+    # count the births of each unique geo and date
+    if consolidate:
+        cols = ", ".join(GEO_COLUMNS)
+        query = (
+            f"SELECT {cols}, count(*) AS births FROM ({query}) "
+            f"GROUP BY {cols} ORDER BY {cols}"
+        )
+
+    with connect(file_path, threads=threads) as con:
+        con.register("states", get_state_table(year, lookup))
+        df = con.execute(query).df()
+
+    dtypes = {col: "category" for col in GEO_COLUMNS}
+    dtypes.update({"dob_mm": np.uint8, "dob_yy": np.uint16, "apgar5": np.uint8})
+    if consolidate:
+        dtypes["births"] = np.int64
+    df = df.astype(dtypes)
+
+    # the records are only in memory as the result of the query
+    log_memory_report(year, df.memory_usage(deep=True).sum())
+    print(f'{year} processing complete')
+    return df
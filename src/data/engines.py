@@ -0,0 +1,76 @@
+"""Registry of the engines the raw birth records can be processed with.
+
+Each engine is a module providing the readers of data_prep_utils
+(df_from_csv_no_geo, df_from_csv_no_geo_extra and df_from_csv_with_geo),
+returning the same dataframes. Engine modules are only imported when they
+are used, so their optional dependencies are only needed then.
+"""
+
+import importlib
+import importlib.util
+
+ENGINES = {
+    # in-memory pandas, reading a csv (or a part of one) per worker of a Pool
+    "pandas": {
+        "module": "src.data.data_prep_utils",
+        "requires": ["pandas"],
+        "parallel_scan": False,
+    },
+    # embedded DuckDB database, reading each csv on every core and spilling to disk
+    "duckdb": {
+        "module": "src.data.duckdb_engine",
+        "requires": ["duckdb"],
+        "parallel_scan": True,
+    },
+}
+
+
+def get_engine(name):
+    """Import the module of an engine (see ENGINES).
+
+    Raises:
+        ValueError: If there is no such engine.
+        ImportError: If the packages the engine needs are not installed.
+    """
+
+    if name not in ENGINES:
+        raise ValueError(f"Unknown engine {name}, expected one of {list(ENGINES)}")
+
+    # check for the packages now, rather than in the middle of a run
+    missing = [
+        package
+        for package in ENGINES[name]["requires"]
+        if importlib.util.find_spec(package) is None
+    ]
+    if missing:
+        raise ImportError(f"The {name} engine needs {missing} installed")
+
+    return importlib.import_module(ENGINES[name]["module"])
+
+
+def scans_in_parallel(name):
+    """Check if an engine reads a single csv on every core itself, in which
+    case the csvs are read one at a time rather than on a Pool.
+    """
+    return ENGINES[name]["parallel_scan"]
+
+
+def map_csvs(name, reader, file_list, threads=None, **kwargs):
+    """Apply a reader of an engine that scans in parallel (see
+    scans_in_parallel) to each raw csv, one csv at a time.
+
+    Args:
+        name (str): Name of the engine (see ENGINES).
+        reader (str): Name of the reader (e.g. "df_from_csv_no_geo").
+        file_list (list): Paths of the raw csvs.
+        threads (int): Number of threads the engine reads each csv with
+            (default: one per core).
+        **kwargs: Other arguments of the reader (e.g. consolidate).
+
+    Yields:
+        tuple: (path of the csv, result of the reader), like
+            scheduler.imap_largest_first.
+    """
+    read = getattr(get_engine(name), reader)
+    for file_path in file_list:
+        yield file_path, read(file_path, threads=threads, **kwargs)
@@ -0,0 +1,150 @@
+"""Timing and memory records of the stages of the data pipeline.
+
+The readers record each stage (read, rename, merge, dropna, groupby, cast
+and write) of their work on a year: its wall time, rows in and out, bytes
+read and the peak RSS of the process. Stages may run inside one another
+(e.g. the rename of each chunk while it is read), but the time of a stage
+does not include that of the stages inside it, so the stages of a process
+add up to no more than its wall time. Records are only kept while recording
+is on. The scheduler turns it on in the workers and hands their records back
+to the driver, which aggregates them into a run report.
+"""
+
+import json
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+STAGES = ["read", "rename", "merge", "dropna", "groupby", "cast", "write"]
+
+# records of this process, or None when not recording
+_records = None
+
+# seconds spent in the stages inside each stage in progress, innermost last
+_nested_seconds = []
+
+
+def start_recording():
+    """Start recording the stages of this process (dropping earlier records)."""
+    global _records
+    _records = []
+
+
+def stop_recording():
+    """Stop recording, and return the records made since start_recording."""
+    global _records
+    records, _records = _records, None
+    return records or []
+
+
+def get_peak_rss_mb():
+    """Get the peak resident memory of this process so far, in MB."""
+    if resource is None:
+        return None
+
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@contextmanager
+def stage(name, year=None, rows_in=None, bytes_read=None):
+    """Record the wall time and peak memory of a stage of the pipeline.
+
+    Yields a dict of the record, so the rows out (rows_out) can be set once
+    they are known. The seconds recorded leave out the time of any stages
+    run inside this one, which are recorded on their own. Setting
+    record["discard"] to True drops the record, e.g. when a reader turns
+    out to have nothing left to read.
+
+    Args:
+        name (str): Name of the stage (one of STAGES).
+        year (int): Year of the csv being processed (None if not of one year).
+        rows_in (int): Number of rows going in to the stage.
+        bytes_read (int): Number of bytes read from disk by the stage.
+
+    """
+
+    record = {
+        "stage": name,
+        "year": year,
+        "rows_in": rows_in,
+        "rows_out": None,
+        "bytes_read": bytes_read,
+    }
+    start = time.perf_counter()
+    _nested_seconds.append(0.0)
+
+    try:
+        yield record
+    finally:
+        seconds = time.perf_counter() - start
+        nested_seconds = _nested_seconds.pop()
+
+        # the stage this one runs in (if any) does not count its time
+        if _nested_seconds:
+            _nested_seconds[-1] += seconds
+
+    if _records is not None and not record.pop("discard", False):
+        record["seconds"] = seconds - nested_seconds
+        record["peak_rss_mb"] = get_peak_rss_mb()
+        _records.append(record)
+
+
+def summarize_records(records, by=("stage",)):
+    """Sum up the records (the max of the peak RSS) by stage, or by year and stage.
+
+    Returns:
+        pd.DataFrame: Seconds, calls, rows in and out, bytes read and peak RSS
+            of each group, in the order of STAGES.
+    """
+
+    columns = ["stage", "year", "seconds", "rows_in", "rows_out", "bytes_read"]
+    df = pd.DataFrame(records, columns=columns + ["peak_rss_mb"])
+    df["year"] = df["year"].astype("Int64")
+    df["stage"] = pd.Categorical(df["stage"], categories=STAGES)
+
+    return (
+        df.groupby(list(by), observed=True, dropna=False)
+        .agg(
+            seconds=("seconds", "sum"),
+            calls=("seconds", "size"),
+            rows_in=("rows_in", "sum"),
+            rows_out=("rows_out", "sum"),
+            bytes_read=("bytes_read", "sum"),
+            peak_rss_mb=("peak_rss_mb", "max"),
+        )
+        .reset_index()
+    )
+
+
+def save_run_report(records, path_report, options=None):
+    """Save the records of a run to a JSON report, with their summaries by
+    stage and by year and stage, and print the summary by stage.
+
+    Returns:
+        pd.DataFrame: The summary by stage.
+    """
+
+    df_stage = summarize_records(records, by=["stage"])
+    df_year = summarize_records(records, by=["year", "stage"])
+
+    report = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "options": options,
+        "by_stage": json.loads(df_stage.to_json(orient="records")),
+        "by_year_and_stage": json.loads(df_year.to_json(orient="records")),
+        "records": records,
+    }
+    Path(path_report).parent.mkdir(parents=True, exist_ok=True)
+    Path(path_report).write_text(json.dumps(report, indent=2))
+
+    print(df_stage.to_string(index=False, float_format=lambda x: f"{x:.2f}"))
+    return df_stage
@@ -0,0 +1,342 @@
+import logging
+from pathlib import Path
+import pandas as pd
+from src.data.data_prep_utils import (
+    df_from_csv_all,
+    merge_birth_counts,
+    merge_table_parts,
+    list_raw_files,
+    load_state_lookup,
+    load_county_lookup,
+    GEO_COLUMNS,
+)
+from src.data.manifest import (
+    load_manifest,
+    save_manifest,
+    make_manifest,
+    find_changed_files,
+    save_partial_tables,
+    load_partial_tables,
+)
+from src.data.binary_store import write_store
+from src.data.instrument import stage, start_recording, stop_recording, save_run_report
+from src.data.schema import get_year
+from src.data.writer import compress_csv_header, submit_csv_blocks, write_members
+from src.data.scheduler import get_pool_size, imap_largest_first
+from multiprocessing import Pool
+import numpy as np
+import argparse
+from functools import partial
+
+
+# tables made by df_from_csv_all
+TABLE_NAMES = [
+    "births_simple",
+    "births_simple_with_apgar",
+    "births_with_geo_apgar_consolidated",
+    "births_with_geo_apgar",
+    "births_by_county",
+    "births_by_city",
+]
+
+# tables whose rows are in order of year, so each year can be written on its own
+YEAR_ORDERED_TABLES = ["births_with_geo_apgar", "births_by_county", "births_by_city"]
+
+
+def get_csv_table(table_name, df):
+    """Get a table as it is saved to csv. Each row of the per-birth table is
+    a single birth, so it is given a births column of ones.
+    """
+    if table_name == "births_with_geo_apgar":
+        return df.assign(births=np.ones(df.shape[0]))
+    return df
+
+
+def main(
+    folder_raw_data,
+    per_birth=False,
+    folder_partials=None,
+    records=None,
+    csv_gz_tables=(),
+):
+    """Runs data processing scripts to turn raw data from (../raw) into
+    cleaned data ready to be analyzed (saved in ../processed).
+
+    Each raw csv is read once, and all the processed tables are made from it.
+
+    If folder_partials is given, the tables of each raw csv are saved there,
+    and only the csvs that are new or changed since the last build (see
+    manifest.py) are processed. The saved tables of the others are reused.
+
+    If records is given, the records of the stages run by the workers (see
+    instrument.py) are added to it.
+
+    The tables named in csv_gz_tables are compressed to gzipped csvs on the
+    pool of workers (see writer.py). The tables in order of year are handed
+    to the pool a year at a time, as soon as each year is done, so the
+    compressing overlaps with the processing of the other years.
+
+    Returns:
+        tuple: The tables (a dataframe per table name), and the gzip members
+            of the tables in csv_gz_tables, header first, ready to be written
+            with writer.write_members.
+    """
+    logger = logging.getLogger(__name__)
+    logger.info("making all the final data sets in a single pass over the raw data")
+
+    # get a list of file names (extracted csvs, or else the zip archives)
+    file_list = list_raw_files(folder_raw_data)
+
+    if folder_partials is not None:
+        # csvs processed before a table was added count as changed
+        options = {"per_birth": per_birth, "tables": TABLE_NAMES}
+        manifest = load_manifest(folder_partials)
+        changed_list, unchanged_list, fingerprints = find_changed_files(
+            file_list, manifest, options=options
+        )
+        logger.info(
+            f"{len(changed_list)} raw csvs to process, {len(unchanged_list)} unchanged"
+        )
+    else:
+        changed_list, unchanged_list = file_list, []
+
+    # build the lookup tables once, so the forked workers share them
+    load_state_lookup(Path(folder_raw_data).parent / "external")
+    load_county_lookup(Path(folder_raw_data).parent / "external")
+
+    # one worker per core that fits in memory, unless --n_cores is given
+    n_workers = get_pool_size(
+        changed_list,
+        chunksize=args.chunksize,
+        n_cores=args.n_cores,
+        split=not args.no_split,
+    )
+
+    # set up your pool
+    with Pool(processes=n_workers) as pool:
+
+        # gzip members of each year of the tables in order of year
+        year_members = {
+            table_name: {}
+            for table_name in csv_gz_tables
+            if table_name in YEAR_ORDERED_TABLES
+        }
+
+        def submit_year(file_path, tables):
+            for table_name in year_members:
+                if tables[table_name] is not None:
+                    year_members[table_name][file_path] = submit_csv_blocks(
+                        pool, get_csv_table(table_name, tables[table_name])
+                    )
+
+        # have your pool map the file names to the tables of each year,
+        # largest file first (large files are split into parts, then merged)
+        tables_by_file = {}
+        for file_path, tables in imap_largest_first(
+            pool,
+            partial(df_from_csv_all, chunksize=args.chunksize, per_birth=per_birth),
+            changed_list,
+            n_workers=None if args.no_split else n_workers,
+            merge=merge_table_parts,
+            records=records,
+        ):
+            # save the tables of each year as soon as it is done
+            if folder_partials is not None:
+                n_rows = sum(len(df) for df in tables.values() if df is not None)
+                with stage("write", get_year(file_path), rows_in=n_rows) as record:
+                    save_partial_tables(folder_partials, file_path, tables)
+                    record["rows_out"] = n_rows
+            tables_by_file[file_path] = tables
+            submit_year(file_path, tables)
+
+        if folder_partials is not None:
+            for file_path in unchanged_list:
+                tables_by_file[file_path] = load_partial_tables(
+                    folder_partials, file_path, TABLE_NAMES
+                )
+                submit_year(file_path, tables_by_file[file_path])
+
+            # only record the csvs once their tables are saved
+            save_manifest(
+                folder_partials, make_manifest(fingerprints, options=options)
+            )
+
+        # put the tables back in order of year
+        table_list = [tables_by_file[file_path] for file_path in file_list]
+
+        # reduce the tables of each year to a single dataframe per table
+        combined_tables = {}
+        for table_name in TABLE_NAMES:
+            df_list = [
+                tables[table_name]
+                for tables in table_list
+                if tables[table_name] is not None
+            ]
+
+            if not df_list:
+                continue
+
+            if table_name == "births_with_geo_apgar_consolidated":
+                combined_tables[table_name] = merge_birth_counts(df_list, GEO_COLUMNS)
+            else:
+                combined_tables[table_name] = pd.concat(df_list, ignore_index=True)
+
+        # the other tables are compressed once they are merged
+        csv_members = {}
+        for table_name in csv_gz_tables:
+            if table_name not in combined_tables:
+                continue
+
+            df = get_csv_table(table_name, combined_tables[table_name].iloc[:0])
+            if table_name in year_members:
+                blocks = [
+                    block
+                    for file_path in file_list
+                    for block in year_members[table_name].get(file_path, [])
+                ]
+            else:
+                blocks = submit_csv_blocks(
+                    pool, get_csv_table(table_name, combined_tables[table_name])
+                )
+
+            # wait for the workers before the pool is closed
+            csv_members[table_name] = [compress_csv_header(df.columns)] + [
+                block.get() for block in blocks
+            ]
+
+    return combined_tables, csv_members
+
+
+if __name__ == "__main__":
+    log_fmt = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    parser = argparse.ArgumentParser(description="Build data sets for analysis")
+
+    parser.add_argument(
+        "--n_cores",
+        type=int,
+        default=None,
+        help="Number of cores to use for multiprocessing "
+        "(default: one per core, as many as fit in memory)",
+    )
+
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=None,
+        help="Stream each csv in chunks of this many rows to bound memory use",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only process the raw csvs that are new or changed since the last build",
+    )
+
+    parser.add_argument(
+        "--per_birth",
+        action="store_true",
+        help="Also save the per-birth table (births_with_geo_apgar.csv.gz)",
+    )
+
+    parser.add_argument(
+        "--per_birth_format",
+        choices=["csv", "mmap"],
+        default="csv",
+        help="Save the per-birth table as a gzipped csv, or as a memory-mapped "
+        "binary store (see binary_store.py) in data/processed/births_with_geo_apgar/",
+    )
+
+    parser.add_argument(
+        "--no_split",
+        action="store_true",
+        help="Do not split large csvs into parts read by separate workers",
+    )
+
+    args = parser.parse_args()
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    if args.incremental:
+        folder_partials = project_dir / "data/interim/partials"
+    else:
+        folder_partials = None
+
+    # record the time and memory of each stage, here and in the workers
+    start_recording()
+    worker_records = []
+
+    # the gzipped csvs are compressed by the workers (see writer.py)
+    csv_gz_tables = [
+        "births_with_geo_apgar_consolidated",
+        "births_by_county",
+        "births_by_city",
+    ]
+    if args.per_birth and args.per_birth_format == "csv":
+        csv_gz_tables.append("births_with_geo_apgar")
+
+    tables, csv_members = main(
+        project_dir / "data/raw/",
+        per_birth=args.per_birth,
+        folder_partials=folder_partials,
+        records=worker_records,
+        csv_gz_tables=csv_gz_tables,
+    )
+
+    df = tables["births_simple"]
+    print("births_simple shape:", df.shape)
+    with stage("write", rows_in=len(df)) as record:
+        df.to_csv(project_dir / "data/processed" / "births_simple.csv", index=False)
+        record["rows_out"] = len(df)
+
+    df = tables["births_simple_with_apgar"]
+    print("births_simple_with_apgar shape:", df.shape)
+    with stage("write", rows_in=len(df)) as record:
+        df.to_csv(
+            project_dir / "data/processed" / "births_simple_with_apgar.csv", index=False
+        )
+        record["rows_out"] = len(df)
+
+    if args.per_birth:
+        df = tables["births_with_geo_apgar"]
+        print("births_with_geo_apgar shape:", df.shape)
+        with stage("write", rows_in=len(df)) as record:
+            if args.per_birth_format == "mmap":
+                # each row is a single birth, so no births column is stored
+                write_store(
+                    df, project_dir / "data/processed" / "births_with_geo_apgar"
+                )
+            else:
+                write_members(
+                    project_dir / "data/processed" / "births_with_geo_apgar.csv.gz",
+                    csv_members["births_with_geo_apgar"],
+                )
+            record["rows_out"] = len(df)
+
+    df = tables["births_with_geo_apgar_consolidated"]
+    print("births_with_geo_apgar_consolidated shape:", df.shape)
+    with stage("write", rows_in=len(df)) as record:
+        write_members(
+            project_dir / "data/processed" / "births_with_geo_apgar_consolidated.csv.gz",
+            csv_members["births_with_geo_apgar_consolidated"],
+        )
+        record["rows_out"] = len(df)
+
+    for table_name in ["births_by_county", "births_by_city"]:
+        df = tables[table_name]
+        print(f"{table_name} shape:", df.shape)
+        with stage("write", rows_in=len(df)) as record:
+            write_members(
+                project_dir / "data/processed" / f"{table_name}.csv.gz",
+                csv_members[table_name],
+            )
+            record["rows_out"] = len(df)
+
+    # save the report of where the time (and memory) went
+    save_run_report(
+        stop_recording() + worker_records,
+        project_dir / "reports/run_report.json",
+        options=vars(args),
+    )
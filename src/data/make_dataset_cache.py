@@ -0,0 +1,65 @@
+import logging
+from pathlib import Path
+from src.data.data_prep_utils import csv_to_cache, list_raw_files
+from src.data.scheduler import get_pool_size, imap_largest_first
+from multiprocessing import Pool
+import argparse
+from functools import partial
+
+
+def main(folder_raw_data):
+    """Converts the raw birth record csvs from (../raw) into compressed
+    parquet files (saved in ../interim), which are then read in place of
+    the csvs when making the final data sets.
+    """
+    logger = logging.getLogger(__name__)
+    logger.info("making the parquet cache of the raw birth record csvs")
+
+    # get a list of file names (extracted csvs, or else the zip archives)
+    file_list = list_raw_files(folder_raw_data)
+
+    # one worker per core that fits in memory, unless --n_cores is given
+    n_workers = get_pool_size(file_list, chunksize=args.chunksize, n_cores=args.n_cores)
+
+    # set up your pool
+    with Pool(processes=n_workers) as pool:
+
+        # have your pool convert each csv, largest file first
+        cache_list = [
+            cache_path
+            for _, cache_path in imap_largest_first(
+                pool, partial(csv_to_cache, chunksize=args.chunksize), file_list
+            )
+        ]
+
+    return cache_list
+
+
+if __name__ == "__main__":
+    log_fmt = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    parser = argparse.ArgumentParser(description="Build parquet cache of raw data")
+
+    parser.add_argument(
+        "--n_cores",
+        type=int,
+        default=None,
+        help="Number of cores to use for multiprocessing "
+        "(default: one per core, as many as fit in memory)",
+    )
+
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=500000,
+        help="Number of csv rows converted at a time",
+    )
+
+    args = parser.parse_args()
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    cache_list = main(project_dir / "data/raw/")
+    print("Number of cached files:", len(cache_list))
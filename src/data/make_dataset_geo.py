@@ -1,42 +1,109 @@
 import logging
 from pathlib import Path
 import pandas as pd
-from src.data.data_prep_utils import df_from_csv_with_geo
+from src.data.data_prep_utils import (
+    df_from_csv_with_geo,
+    count_geo_births,
+    merge_birth_counts,
+    list_raw_files,
+    load_state_lookup,
+    GEO_COLUMNS,
+)
+from src.data.binary_store import write_store
+from src.data.engines import ENGINES, map_csvs, scans_in_parallel
+from src.data.scheduler import get_cpu_count, get_pool_size, imap_largest_first
+from src.data.writer import to_csv_gz
 from multiprocessing import Pool
-import os
 import numpy as np
 import argparse
+from contextlib import nullcontext
+from functools import partial
 
 
-def main(folder_raw_data):
+def main(folder_raw_data, consolidate=True):
     """Runs data processing scripts to turn raw data from (../raw) into
     cleaned data ready to be analyzed (saved in ../processed).
+
+    If consolidate is True, each worker returns the birth counts for its
+    year and only these partial counts are merged, rather than every record.
     """
     logger = logging.getLogger(__name__)
     logger.info(
         "making the final data set with geo data, but nothing extra (e.g APGAR data)"
     )
 
-    # get a list of file names
-    files = os.listdir(folder_raw_data)
-
-    file_list = [
-        Path(folder_raw_data) / filename
-        for filename in files
-        if filename.endswith(".csv")
-    ]
+    # get a list of file names (extracted csvs, or else the zip archives)
+    file_list = list_raw_files(folder_raw_data)
+
+    # build the state lookup table once, so the forked workers share it
+    load_state_lookup(Path(folder_raw_data).parent / "external")
+
+    if scans_in_parallel(args.engine):
+        # the engine reads each csv on every core itself, one csv at a time
+        pool_context = nullcontext()
+    else:
+        # one worker per core that fits in memory, unless --n_cores is given
+        n_workers = get_pool_size(
+            file_list,
+            chunksize=args.chunksize,
+            n_cores=args.n_cores,
+            split=not args.no_split,
+        )
+        pool_context = Pool(processes=n_workers)
 
     # set up your pool
-    with Pool(processes=args.n_cores) as pool:  # or whatever your hardware can support
-
-        # have your pool map the file names to dataframes
-        df_list = pool.map(df_from_csv_with_geo, file_list)
-
-        # reduce the list of dataframes to a single dataframe
-        combined_df = pd.concat(df_list, ignore_index=True)
-        print(combined_df.shape)
-
-        return combined_df
+    with pool_context as pool:
+
+        # large files are split into parts, which are merged like the years
+        if consolidate:
+            merge = partial(merge_birth_counts, group_cols=GEO_COLUMNS)
+        else:
+            merge = partial(pd.concat, ignore_index=True)
+
+        # have your pool map the file names to dataframes, largest file first
+        if pool is None:
+            results = map_csvs(
+                args.engine,
+                "df_from_csv_with_geo",
+                file_list,
+                threads=args.n_cores,
+                consolidate=consolidate,
+            )
+        else:
+            results = imap_largest_first(
+                pool,
+                partial(
+                    df_from_csv_with_geo,
+                    consolidate=consolidate,
+                    chunksize=args.chunksize,
+                ),
+                file_list,
+                n_workers=None if args.no_split else n_workers,
+                merge=merge,
+            )
+
+        combined_df = None
+        df_by_file = {}
+        for file_path, df in results:
+            # years without geo data return None
+            if df is None:
+                continue
+
+            # merge the birth counts of each year as soon as it is done
+            if consolidate:
+                df_list = [df] if combined_df is None else [combined_df, df]
+                combined_df = merge_birth_counts(df_list, GEO_COLUMNS)
+            else:
+                df_by_file[file_path] = df
+
+    # reduce the per-birth dataframes to a single dataframe, in order of year
+    if not consolidate:
+        combined_df = pd.concat(
+            [df_by_file[f] for f in file_list if f in df_by_file], ignore_index=True
+        )
+    print(combined_df.shape)
+
+    return combined_df
 
 
 if __name__ == "__main__":
@@ -48,8 +115,44 @@ if __name__ == "__main__":
     parser.add_argument(
         "--n_cores",
         type=int,
-        default=16,
-        help="Number of cores to use for multiprocessing",
+        default=None,
+        help="Number of cores to use for multiprocessing "
+        "(default: one per core, as many as fit in memory)",
+    )
+
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=None,
+        help="Stream each csv in chunks of this many rows to bound memory use",
+    )
+
+    parser.add_argument(
+        "--per_birth",
+        action="store_true",
+        help="Also save the per-birth table (births_with_geo_apgar.csv.gz)",
+    )
+
+    parser.add_argument(
+        "--per_birth_format",
+        choices=["csv", "mmap"],
+        default="csv",
+        help="Save the per-birth table as a gzipped csv, or as a memory-mapped "
+        "binary store (see binary_store.py) in data/processed/births_with_geo_apgar/",
+    )
+
+    parser.add_argument(
+        "--engine",
+        choices=list(ENGINES),
+        default="pandas",
+        help="Engine to process the csvs with (see engines.py). duckdb reads "
+        "each csv on every core (--n_cores threads), spilling to disk",
+    )
+
+    parser.add_argument(
+        "--no_split",
+        action="store_true",
+        help="Do not split large csvs into parts read by separate workers",
     )
 
     args = parser.parse_args()
@@ -58,28 +161,39 @@ if __name__ == "__main__":
     project_dir = Path(__file__).resolve().parents[2]
     print(type(project_dir))
 
-    df = main(project_dir / "data/raw/")
-    print("Final df shape:", df.shape)
-
-    df["births"] = np.ones(df.shape[0])
-    df.to_csv(
-        project_dir / "data/processed" / "births_with_geo_apgar.csv.gz",
-        compression="gzip",
-        index=False,
-    )
+    if args.per_birth:
+        df = main(project_dir / "data/raw/", consolidate=False)
+        print("Final df shape:", df.shape)
+
+        if args.per_birth_format == "mmap":
+            # each row is a single birth, so no births column is stored
+            write_store(df, project_dir / "data/processed" / "births_with_geo_apgar")
+            df["births"] = np.ones(df.shape[0])
+        else:
+            df["births"] = np.ones(df.shape[0])
+
+            # compress blocks of the rows on every core (see writer.py)
+            with Pool(processes=args.n_cores or get_cpu_count()) as pool:
+                to_csv_gz(
+                    df,
+                    project_dir / "data/processed" / "births_with_geo_apgar.csv.gz",
+                    pool=pool,
+                )
+
+        # create a birth count for each unique geo and date, the same way the
+        # workers do when consolidating (only the categories that occur)
+        # this should reduce the size of the df significantly
+        df = merge_birth_counts([count_geo_births(df)], GEO_COLUMNS)
+
+    else:
+        # workers count the births for each unique geo and date themselves
+        df = main(project_dir / "data/raw/", consolidate=True)
 
-    # create a birth count for each unique geo and date
-    # this should reduce the size of the df significantly
-    # df = df.drop(columns=["apgar5"]) # not needed in consolidated table
-    df = (
-        df.groupby(list(df.columns)[:-1], as_index=False)
-        .count()
-        .sort_values(by=["dob_yy", "dob_mm"])
-    )
     print("Shape after consolidated birth count:", df.shape)
 
-    df.to_csv(
-        project_dir / "data/processed" / "births_with_geo_apgar_consolidated.csv.gz",
-        compression="gzip",
-        index=False,
-    )
+    with Pool(processes=args.n_cores or get_cpu_count()) as pool:
+        to_csv_gz(
+            df,
+            project_dir / "data/processed" / "births_with_geo_apgar_consolidated.csv.gz",
+            pool=pool,
+        )
@@ -1,10 +1,16 @@
 import logging
 from pathlib import Path
 import pandas as pd
-from src.data.data_prep_utils import df_from_csv_no_geo
+from src.data.data_prep_utils import (
+    df_from_csv_no_geo,
+    merge_birth_counts,
+    list_raw_files,
+)
+from src.data.engines import ENGINES, map_csvs, scans_in_parallel
+from src.data.scheduler import get_pool_size, imap_largest_first
 from multiprocessing import Pool
-import os
 import argparse
+from functools import partial
 
 
 def main(folder_raw_data):
@@ -16,24 +22,42 @@ def main(folder_raw_data):
         "making the final data set WITHOUT geo data, and WITHOUT any extra data (e.g APGAR data)"
     )
 
-    # get a list of file names
-    files = os.listdir(folder_raw_data)
-    file_list = [
-        Path(folder_raw_data) / filename
-        for filename in files
-        if filename.endswith(".csv")
-    ]
+    # get a list of file names (extracted csvs, or else the zip archives)
+    file_list = list_raw_files(folder_raw_data)
 
-    # set up your pool
-    with Pool(processes=args.n_cores) as pool:  # or whatever your hardware can support
+    if scans_in_parallel(args.engine):
+        # the engine reads each csv on every core itself, one csv at a time
+        df_by_file = dict(
+            map_csvs(args.engine, "df_from_csv_no_geo", file_list, threads=args.n_cores)
+        )
+    else:
+        # one worker per core that fits in memory, unless --n_cores is given
+        n_workers = get_pool_size(
+            file_list,
+            chunksize=args.chunksize,
+            n_cores=args.n_cores,
+            split=not args.no_split,
+        )
 
-        # have your pool map the file names to dataframes
-        df_list = pool.map(df_from_csv_no_geo, file_list)
+        # set up your pool
+        with Pool(processes=n_workers) as pool:
 
-        # reduce the list of dataframes to a single dataframe
-        combined_df = pd.concat(df_list, ignore_index=True)
+            # have your pool map the file names to dataframes, largest file first
+            # (large files are split into parts, whose birth counts are merged)
+            df_by_file = dict(
+                imap_largest_first(
+                    pool,
+                    partial(df_from_csv_no_geo, chunksize=args.chunksize),
+                    file_list,
+                    n_workers=None if args.no_split else n_workers,
+                    merge=partial(merge_birth_counts, group_cols=["dob_yy", "dob_mm"]),
+                )
+            )
 
-        return combined_df
+    # reduce the dataframes to a single dataframe, in order of year
+    combined_df = pd.concat([df_by_file[f] for f in file_list], ignore_index=True)
+
+    return combined_df
 
 
 if __name__ == "__main__":
@@ -45,8 +69,30 @@ if __name__ == "__main__":
     parser.add_argument(
         "--n_cores",
         type=int,
-        default=16,
-        help="Number of cores to use for multiprocessing",
+        default=None,
+        help="Number of cores to use for multiprocessing "
+        "(default: one per core, as many as fit in memory)",
+    )
+
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=None,
+        help="Stream each csv in chunks of this many rows to bound memory use",
+    )
+
+    parser.add_argument(
+        "--engine",
+        choices=list(ENGINES),
+        default="pandas",
+        help="Engine to process the csvs with (see engines.py). duckdb reads "
+        "each csv on every core (--n_cores threads), spilling to disk",
+    )
+
+    parser.add_argument(
+        "--no_split",
+        action="store_true",
+        help="Do not split large csvs into parts read by separate workers",
     )
 
     args = parser.parse_args()
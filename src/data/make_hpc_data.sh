@@ -11,6 +11,4 @@ module load python/3.8
 
 source ~/cdcbirth/bin/activate
 
-python src/data/make_dataset_geo.py --n_cores 16
-python src/data/make_dataset_no_geo.py --n_cores 16
-python src/data/make_dataset_no_geo_extra.py --n_cores 16
\ No newline at end of file
+python src/data/make_dataset.py --n_cores 16
\ No newline at end of file
@@ -0,0 +1,147 @@
+"""Manifest of the raw birth record csvs used to build the processed tables.
+
+For each raw csv the manifest records a fingerprint (size, mtime and sha1,
+and those of the parquet cache it is read from, if any) and the options it
+was processed with. The tables made from each csv are
+saved as partial outputs, so a rebuild only needs to process the csvs that
+are new or have changed, and then merge the partial outputs again.
+"""
+
+import hashlib
+import json
+import shutil
+from pathlib import Path
+
+import pandas as pd
+
+from src.data.data_prep_utils import get_cache_fingerprint
+
+
+def file_sha1(file_path, block_size=2 ** 20):
+    """Hash the contents of a file, reading it in blocks."""
+    h = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_fingerprint(file_path, previous=None):
+    """Get the fingerprint (size, mtime and sha1) of a file, along with the
+    fingerprint of the parquet cache it is read from (see
+    data_prep_utils.get_cache_fingerprint), as the cache is read in its place.
+
+    If the size and mtime match the previous fingerprint, the file is
+    assumed unchanged and its sha1 is not recomputed.
+    """
+    stat = Path(file_path).stat()
+    fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime}
+
+    if (
+        previous is not None
+        and previous["size"] == fingerprint["size"]
+        and previous["mtime"] == fingerprint["mtime"]
+    ):
+        fingerprint["sha1"] = previous["sha1"]
+    else:
+        fingerprint["sha1"] = file_sha1(file_path)
+
+    # a cache of an older version of the file is not read (and has no fingerprint)
+    fingerprint["cache"] = get_cache_fingerprint(file_path)
+
+    return fingerprint
+
+
+def load_manifest(folder_partials):
+    """Load the manifest from a folder of partial outputs."""
+    path_manifest = Path(folder_partials) / "manifest.json"
+    if path_manifest.exists():
+        return json.loads(path_manifest.read_text())
+    return {}
+
+
+def save_manifest(folder_partials, manifest):
+    """Save the manifest to a folder of partial outputs."""
+    Path(folder_partials).mkdir(parents=True, exist_ok=True)
+    (Path(folder_partials) / "manifest.json").write_text(
+        json.dumps(manifest, indent=2, sort_keys=True)
+    )
+
+
+def find_changed_files(file_list, manifest, options=None):
+    """Split the raw csvs into those that must be processed again (new, or
+    changed since they were last processed, or read from another cache) and
+    those that are unchanged.
+
+    Args:
+        file_list (list): Paths of the raw csvs.
+        manifest (dict): The manifest, created using load_manifest.
+        options (dict): Options the csvs are processed with. A csv processed
+            with other options counts as changed.
+
+    Returns:
+        tuple: (changed files, unchanged files, fingerprints of all the files)
+    """
+
+    changed, unchanged, fingerprints = [], [], {}
+    for file_path in file_list:
+        entry = manifest.get(Path(file_path).name)
+        previous = None if entry is None else entry["fingerprint"]
+
+        fingerprint = file_fingerprint(file_path, previous=previous)
+        fingerprints[Path(file_path).name] = fingerprint
+
+        if (
+            entry is not None
+            and entry["fingerprint"]["sha1"] == fingerprint["sha1"]
+            and entry["fingerprint"].get("cache") == fingerprint["cache"]
+            and entry["options"] == options
+        ):
+            unchanged.append(file_path)
+        else:
+            changed.append(file_path)
+
+    return changed, unchanged, fingerprints
+
+
+def get_partials_path(folder_partials, file_path):
+    """Get the folder holding the partial outputs of a raw csv."""
+    return Path(folder_partials) / Path(file_path).stem
+
+
+def save_partial_tables(folder_partials, file_path, tables):
+    """Save the tables made from a raw csv (a dict of dataframes,
+    or None for tables the csv has no data for) as parquet files.
+    """
+    path_partials = get_partials_path(folder_partials, file_path)
+
+    # clear out tables from previous builds
+    if path_partials.exists():
+        shutil.rmtree(path_partials)
+    path_partials.mkdir(parents=True)
+
+    for table_name, df in tables.items():
+        if df is not None:
+            df.to_parquet(path_partials / f"{table_name}.parquet", index=False)
+
+
+def load_partial_tables(folder_partials, file_path, table_names):
+    """Load the saved tables made from a raw csv (see save_partial_tables)."""
+    path_partials = get_partials_path(folder_partials, file_path)
+
+    tables = {}
+    for table_name in table_names:
+        path_table = path_partials / f"{table_name}.parquet"
+        tables[table_name] = pd.read_parquet(path_table) if path_table.exists() else None
+
+    return tables
+
+
+def make_manifest(fingerprints, options=None):
+    """Make the manifest recording the fingerprints of the raw csvs.
+    Csvs that are no longer there are left out.
+    """
+    return {
+        file_name: {"fingerprint": fingerprint, "options": options}
+        for file_name, fingerprint in fingerprints.items()
+    }
@@ -0,0 +1,230 @@
+"""Scheduling of the raw birth record csvs over a pool of workers.
+
+The csvs range from under a million births (the 1970s) to over four million
+(the late 2000s), so the largest are started first, and handed out one at a
+time, so that a big year is not left to run on its own at the end. Large
+csvs can also be split into byte ranges, read by separate workers, whose
+results are then merged. The results are yielded as the workers finish
+them, so they can be reduced while the other years are still being processed.
+"""
+
+import os
+import zipfile
+from functools import partial
+from pathlib import Path
+
+from src.data.instrument import start_recording, stop_recording
+from src.data.data_prep_utils import (
+    get_current_cache_path,
+    get_zip_member,
+    split_byte_ranges,
+)
+
+# rough size of a record in a raw csv, used to estimate the memory of a chunk
+BYTES_PER_RECORD = 1000
+
+# csvs are not split into parts smaller than this, as each part has some overhead
+MIN_PART_BYTES = 64 * 2 ** 20
+
+
+def get_raw_size(file_path):
+    """Get the size of a raw csv in bytes (uncompressed, for a zip archive)."""
+    file_path = Path(file_path)
+    if file_path.suffix == ".zip":
+        with zipfile.ZipFile(file_path) as zip_file:
+            return zip_file.getinfo(get_zip_member(zip_file)).file_size
+
+    return file_path.stat().st_size
+
+
+def get_available_memory():
+    """Get the memory available to new processes, in bytes (None if unknown)."""
+
+    # MemAvailable also counts the page cache that can be freed
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def get_cpu_count():
+    """Get the number of cores this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def get_part_size(file_list, n_workers):
+    """Get the size (in bytes) the raw csvs are split into parts of, so that
+    there is about one part per worker, but no part is under MIN_PART_BYTES.
+    """
+    total = sum(get_raw_size(file_path) for file_path in file_list)
+    return max(total // max(n_workers, 1), MIN_PART_BYTES)
+
+
+def estimate_worker_memory(file_list, chunksize=None, part_size=None):
+    """Estimate the memory a worker needs for the largest raw csv, in bytes.
+
+    A whole csv (or a part of part_size bytes of it) is assumed to take up
+    about as much memory as its text, and a chunk about BYTES_PER_RECORD
+    per record.
+    """
+
+    if not file_list:
+        return 0
+
+    largest = max(get_raw_size(file_path) for file_path in file_list)
+    if part_size is not None:
+        largest = min(largest, part_size)
+
+    if chunksize is None:
+        return largest
+
+    return min(largest, chunksize * BYTES_PER_RECORD)
+
+
+def get_pool_size(file_list, chunksize=None, n_cores=None, split=False):
+    """Get the number of workers to process the raw csvs with.
+
+    Args:
+        file_list (list): Paths of the raw csvs.
+        chunksize (int): Number of rows the csvs are read in per chunk.
+        n_cores (int): Number of workers to use. If None, one per core,
+            but no more than fit in the available memory, or than there are
+            csvs (unless they are split).
+        split (bool): Whether the csvs are split into parts (see plan_tasks).
+
+    """
+
+    if n_cores is not None:
+        return n_cores
+
+    if split:
+        pool_size = get_cpu_count()
+        part_size = get_part_size(file_list, pool_size)
+    else:
+        pool_size = min(get_cpu_count(), max(len(file_list), 1))
+        part_size = None
+
+    available = get_available_memory()
+    worker_memory = estimate_worker_memory(
+        file_list, chunksize=chunksize, part_size=part_size
+    )
+    if available is not None and worker_memory > 0:
+        pool_size = min(pool_size, max(available // worker_memory, 1))
+
+    return int(pool_size)
+
+
+def plan_tasks(file_list, n_workers=None):
+    """Split the raw csvs into the tasks handed to the workers.
+
+    If n_workers is given, the csvs are split into byte ranges (see
+    split_byte_ranges) of about get_part_size bytes, so that a single year
+    also keeps all the workers busy. Zip archives, and csvs with a current
+    parquet cache (see csv_to_cache), are not split.
+
+    Returns:
+        list: (path of the csv, byte range or None) of each task, largest first
+    """
+
+    tasks = []
+    part_size = None if n_workers is None else get_part_size(file_list, n_workers)
+    for file_path in file_list:
+        size = get_raw_size(file_path)
+        n_parts = 1 if part_size is None else -(-size // part_size)
+
+        if (
+            n_parts > 1
+            and Path(file_path).suffix == ".csv"
+            and get_current_cache_path(file_path) is None
+        ):
+            for byte_range in split_byte_ranges(file_path, n_parts):
+                tasks.append((byte_range[1] - byte_range[0], file_path, byte_range))
+        else:
+            tasks.append((size, file_path, None))
+
+    tasks = sorted(tasks, key=lambda task: task[0], reverse=True)
+    return [(file_path, byte_range) for _, file_path, byte_range in tasks]
+
+
+def call_task(func, task):
+    """Call func on the csv of a task (and its byte range, if it has one),
+    and return the task along with the result and the records of its
+    stages (see instrument.stage).
+    """
+    file_path, byte_range = task
+
+    start_recording()
+    if byte_range is None:
+        result = func(file_path)
+    else:
+        result = func(file_path, byte_range=byte_range)
+
+    return task, result, stop_recording()
+
+
+def imap_largest_first(
+    pool, func, file_list, n_workers=None, merge=None, records=None
+):
+    """Apply func to each raw csv on a pool of workers, largest csv first.
+
+    The csvs are handed out one at a time (a chunksize of 1), so the workers
+    stay busy until the last one is done.
+
+    Args:
+        pool (Pool): The pool of workers.
+        func (function): Function taking the path of a csv (and a byte_range
+            keyword argument, if the csvs are split).
+        file_list (list): Paths of the raw csvs.
+        n_workers (int): If given along with merge, the csvs are split into
+            parts (see plan_tasks) for about this many workers.
+        merge (function): Function merging the list of results of the parts
+            of a csv, in order, into the result of the csv. If the parts
+            all return None, so does the csv.
+        records (list): If given, the records of the stages run by the
+            workers (see instrument.stage) are added to it.
+
+    Yields:
+        tuple: (path of the csv, result of func) in the order they finish
+    """
+
+    if merge is None:
+        n_workers = None
+
+    tasks = plan_tasks(file_list, n_workers=n_workers)
+    n_parts = {}
+    for file_path, _ in tasks:
+        n_parts[file_path] = n_parts.get(file_path, 0) + 1
+
+    parts = {}
+    for (file_path, byte_range), result, task_records in pool.imap_unordered(
+        partial(call_task, func), tasks, chunksize=1
+    ):
+        if records is not None:
+            records.extend(task_records)
+
+        if byte_range is None:
+            yield file_path, result
+            continue
+
+        # merge the parts of a csv once they are all done
+        parts.setdefault(file_path, []).append((byte_range[0], result))
+        if len(parts[file_path]) == n_parts[file_path]:
+            file_parts = sorted(parts.pop(file_path), key=lambda part: part[0])
+            results = [result for _, result in file_parts]
+
+            # csvs without any results (e.g. no geo data) stay without
+            if all(result is None for result in results):
+                yield file_path, None
+            else:
+                yield file_path, merge(results)
@@ -0,0 +1,195 @@
+"""Registry of the column names used in the NBER natality csvs of each year.
+
+The csvs have changed format several times since 1968. Each field is given
+a single (logical) name, taken from the 2003+ csvs, and the registry below
+resolves the column holding that field in any year's csv.
+"""
+
+import re
+from pathlib import Path
+
+import pandas as pd
+
+# source column of each field, for each format of the csvs
+SCHEMAS = [
+    # 2019 and 2020 columns are capitalized
+    {
+        "years": (2019, 2020),
+        "columns": {
+            "dob_yy": "DOB_YY",
+            "dob_mm": "DOB_MM",
+            "dob_wk": "DOB_WK",
+            "apgar5": "APGAR5",
+        },
+    },
+    # columns for 2003 through 2018
+    {
+        "years": (2003, 2018),
+        "columns": {
+            "dob_yy": "dob_yy",
+            "dob_mm": "dob_mm",
+            "dob_wk": "dob_wk",
+            "mrstate": "mrstate",
+            "mrcntyfips": "mrcntyfips",
+            "mrcityfips": "mrcityfips",
+            "apgar5": "apgar5",
+        },
+    },
+    # columns for 1989-2002
+    {
+        "years": (1989, 2002),
+        "columns": {
+            "dob_yy": "biryr",
+            "dob_mm": "birmon",
+            "dob_wk": "weekday",
+            "mrstate": "stresfip",
+            "mrcntyfips": "cntyrfip",
+            "mrcityfips": "cityres",
+            "apgar5": "fmaps",
+        },
+    },
+    # columns for 1968 through 1988
+    # years before 1989 only show a single digit (i.e. 2 for 1982)
+    {
+        "years": (1968, 1988),
+        "columns": {
+            "dob_yy": "datayear",
+            "dob_mm": "birmon",
+            "dob_day": "birday",
+            "mrstate": "stresfip",
+            "mrcntyfips": "cntyrfip",
+            "mrcityfips": "cityres",
+            "apgar5": "fmaps",
+        },
+        "single_digit_year": True,
+    },
+]
+
+# years in which each field is recorded
+# (geo data is only public from 1982 to 2004, apgar5 starts in 1978)
+FIELD_YEARS = {
+    "dob_yy": (1968, 2020),
+    "dob_mm": (1968, 2020),
+    "dob_wk": (1989, 2020),
+    "dob_day": (1969, 1988),
+    "mrstate": (1982, 2004),
+    "mrcntyfips": (1982, 2004),
+    "mrcityfips": (1982, 2004),
+    "apgar5": (1978, 2020),
+}
+
+FIELDS = list(FIELD_YEARS)
+
+# dtype each field is loaded as (nullable, so that missing values are kept)
+# codes (e.g. FIPS) are categories so that they keep their leading zeros
+FIELD_DTYPES = {
+    "dob_yy": "UInt16",
+    "dob_mm": "UInt8",
+    "dob_wk": "UInt8",
+    "dob_day": "UInt8",
+    "mrstate": "category",
+    "mrcntyfips": "category",
+    "mrcityfips": "category",
+    "apgar5": "UInt8",
+}
+
+
+def get_year(file_path):
+    """Get the year of a birth record csv from its name (e.g. natl1990.csv)."""
+    return int(re.search(r"\d{4}", Path(file_path).name).group())
+
+
+def get_schema(year):
+    """Get the entry of SCHEMAS covering a year."""
+    for schema in SCHEMAS:
+        if schema["years"][0] <= year <= schema["years"][1]:
+            return schema
+
+    raise ValueError(f"No schema for the birth record csvs of {year}")
+
+
+def fields_available(year, fields):
+    """Check if all the fields are recorded in a year's csv."""
+    return all(
+        FIELD_YEARS[field][0] <= year <= FIELD_YEARS[field][1] for field in fields
+    )
+
+
+def available_fields(year):
+    """Get the fields recorded in a year's csv."""
+    return [field for field in FIELDS if fields_available(year, [field])]
+
+
+def resolve_columns(year, fields):
+    """Map the fields to the names of the columns holding them in a
+    year's csv.
+    """
+
+    missing = [field for field in fields if not fields_available(year, [field])]
+    if missing:
+        raise KeyError(f"{missing} not recorded in the birth record csvs of {year}")
+
+    columns = get_schema(year)["columns"]
+    return {field: columns[field] for field in fields}
+
+
+def read_dct(year, desc_dir):
+    """Read the Stata dictionary ({year}.dct in desc_dir) laying out the
+    fixed-width records of a year (see read_fields_fwf).
+
+    Lines are like '_column(25)  str2  stresfip  %2s  "State of Residence"'.
+    The storage type and label may be left out.
+
+    Returns a dataframe with the columns var_name, start (0-based byte
+    offset in the record), width, storage_type and var_label.
+    """
+
+    text = (Path(desc_dir) / f"{year}.dct").read_text(errors="ignore")
+
+    pattern = re.compile(
+        r"^_column\((?P<column>\d+)\)\s+"
+        r"(?:(?P<storage_type>byte|int|long|float|double|str\d+)\s+)?"
+        r"(?P<var_name>\w+)\s+%(?P<width>\d+)(?:\.\d+)?[a-z]+"
+        r"(?:\s+\"(?P<var_label>.*)\")?"
+    )
+    rows = [
+        match.groupdict()
+        for match in (pattern.match(line.strip()) for line in text.splitlines())
+        if match is not None
+    ]
+
+    df = pd.DataFrame(
+        rows, columns=["var_name", "column", "width", "storage_type", "var_label"]
+    )
+    df["var_name"] = df["var_name"].str.lower()
+    df["start"] = df["column"].astype(int) - 1
+    df["width"] = df["width"].astype(int)
+    return df[["var_name", "start", "width", "storage_type", "var_label"]]
+
+
+def resolve_layout(year, fields, desc_dir):
+    """Resolve the byte offset and width of each field in the fixed-width
+    records of a year, from its Stata dictionary (see read_dct).
+
+    Returns a dataframe indexed by field, with the columns column, start,
+    width and dtype (the dtype the field is loaded as, see FIELD_DTYPES).
+    """
+
+    columns = resolve_columns(year, fields)
+    df_dct = read_dct(year, desc_dir).set_index("var_name")
+
+    missing = [
+        column for column in columns.values() if column.lower() not in df_dct.index
+    ]
+    if missing:
+        raise KeyError(f"{missing} not in the data dictionary of {year}")
+
+    return pd.DataFrame(
+        {
+            "column": [columns[field] for field in fields],
+            "start": [df_dct.loc[columns[field].lower(), "start"] for field in fields],
+            "width": [df_dct.loc[columns[field].lower(), "width"] for field in fields],
+            "dtype": [FIELD_DTYPES[field] for field in fields],
+        },
+        index=pd.Index(fields, name="field"),
+    )
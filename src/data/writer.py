@@ -0,0 +1,89 @@
+"""Parallel writing of the processed tables to gzipped csvs.
+
+A gzip file may hold several members (compressed streams), one after
+another, which are read back as a single stream by gzip, pandas and zcat.
+So a table is cut into blocks of rows, each block is formatted as csv and
+compressed on its own, on a pool of workers, and the members are written
+out in order, after a member holding the header. Blocks can be handed to
+the pool as soon as their rows are ready, e.g. for each year while the
+other years are still being processed.
+"""
+
+import gzip
+from itertools import chain
+
+import pandas as pd
+
+# number of rows formatted and compressed by a worker at a time
+BLOCK_ROWS = 250000
+
+# the default of gzip (9) is several times slower for a few percent smaller files
+COMPRESS_LEVEL = 6
+
+
+def compress_csv_block(df, header=False, compresslevel=COMPRESS_LEVEL):
+    """Format a dataframe as csv (without its index), and compress it to a
+    gzip member.
+
+    Returns:
+        bytes: The gzip member.
+    """
+    text = df.to_csv(index=False, header=header)
+    return gzip.compress(text.encode(), compresslevel=compresslevel, mtime=0)
+
+
+def compress_csv_header(columns, compresslevel=COMPRESS_LEVEL):
+    """Compress the header line of a csv with these columns to a gzip member."""
+    return compress_csv_block(
+        pd.DataFrame(columns=list(columns)), header=True, compresslevel=compresslevel
+    )
+
+
+def split_blocks(df, block_rows=BLOCK_ROWS):
+    """Split a dataframe into blocks of block_rows rows (the last may be smaller)."""
+    return [df.iloc[i : i + block_rows] for i in range(0, len(df), block_rows)]
+
+
+def submit_csv_blocks(pool, df, block_rows=BLOCK_ROWS):
+    """Start compressing the rows of a dataframe (without the header) on a
+    pool of workers, a block at a time.
+
+    Returns:
+        list: AsyncResult of the gzip member of each block, in order.
+    """
+    return [
+        pool.apply_async(compress_csv_block, (block,))
+        for block in split_blocks(df, block_rows)
+    ]
+
+
+def write_members(path, members):
+    """Write gzip members (bytes, or AsyncResults of them) to a file, in order.
+
+    An AsyncResult is only waited on when it is its turn to be written, so
+    the members are written while the later ones are still being compressed.
+    """
+    with open(path, "wb") as f:
+        for member in members:
+            f.write(member if isinstance(member, bytes) else member.get())
+
+
+def to_csv_gz(df, path, pool=None, block_rows=BLOCK_ROWS):
+    """Save a dataframe to a gzipped csv, like
+    df.to_csv(path, compression="gzip", index=False).
+
+    Args:
+        df (pd.DataFrame): The table to save.
+        path (Path): Path of the csv.gz file.
+        pool (Pool): Pool of workers the blocks of rows are compressed on.
+            If None, they are compressed one after another.
+        block_rows (int): Number of rows in each block.
+
+    """
+
+    if pool is None:
+        members = (compress_csv_block(block) for block in split_blocks(df, block_rows))
+    else:
+        members = submit_csv_blocks(pool, df, block_rows=block_rows)
+
+    write_members(path, chain([compress_csv_header(df.columns)], members))
@@ -1,18 +1,19 @@
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 from pathlib import Path
 import pathlib
-import seaborn as sns
 import datetime
 import logging
 import os
 import argparse
+import hashlib
+import json
+from multiprocessing import Pool
 
-from dateutil.relativedelta import relativedelta
-import plotly.graph_objects as go
-import plotly.io as pio
-from src.data.data_prep_utils import percentage_birts_by_month, filter_by_year, df_birth_no_geo_prep
+# the plotting libraries (matplotlib, seaborn and plotly) are slow to import,
+# so they are imported by the functions using them, and not by --help or
+# by workers rendering other charts
+from src.data.data_prep_utils import percentage_birts_by_month, filter_by_year, df_birth_no_geo_prep, make_birth_cube, MONTH_NAMES
 
 ###############################################################################
 # Helper functions
@@ -36,120 +37,87 @@ def human_format(num):
 def plot_births_by_month(df, year=1990, path_save_dir=None, dpi=300, save_plot=True):
     """Plot the births by month for a given year.
 
+    Uses the object-oriented matplotlib API (no global pyplot state), so
+    that several plots can be made at once in different processes.
+
     Args:
         df (pd.DataFrame): The raw birth data. Requires columns: dob_yy, dob_mm, births.
+            May also be a cube created with make_birth_cube.
         year (int): The year to filter the data to.
 
+    Returns:
+        matplotlib.figure.Figure: The figure.
     """
 
+    import seaborn as sns
+    from matplotlib.figure import Figure
+
     df = filter_by_year(df, filter_cat="dob_yy", year=year)
 
     # plot
-    sns.set(font_scale=1.1, style="whitegrid")  # set format
-
-    fig, ax = plt.subplots(
-        nrows=1,
-        ncols=1,
-        figsize=(6, 8),
-    )
-
-    y_val = "birth_month"
-
-    sns.barplot(x="births", y=y_val, data=df, palette="Blues_d", ci=None)
-
-    for i, p in enumerate(ax.patches):
-        # help from https://stackoverflow.com/a/56780852/9214620
-        space = df["births"].max() * 0.01
-        _x = p.get_x() + p.get_width() + float(space)
-        _y = p.get_y() + p.get_height() / 2
-        value = p.get_width()
-        ax.text(
-            _x,
-            _y,
-            f"{human_format(value)}",
-            ha="left",
-            va="center",
-            weight="semibold",
-            size=12,
+    with sns.axes_style("whitegrid"), sns.plotting_context(font_scale=1.1):  # set format
+
+        fig = Figure(figsize=(6, 8))
+        ax = fig.subplots(nrows=1, ncols=1)
+
+        y_val = "birth_month"
+
+        sns.barplot(x="births", y=y_val, data=df, palette="Blues_d", ci=None, ax=ax)
+
+        for i, p in enumerate(ax.patches):
+            # help from https://stackoverflow.com/a/56780852/9214620
+            space = df["births"].max() * 0.01
+            _x = p.get_x() + p.get_width() + float(space)
+            _y = p.get_y() + p.get_height() / 2
+            value = p.get_width()
+            ax.text(
+                _x,
+                _y,
+                f"{human_format(value)}",
+                ha="left",
+                va="center",
+                weight="semibold",
+                size=12,
+            )
+
+        ax.spines["bottom"].set_visible(True)
+        ax.set_ylabel("")
+        ax.set_xlabel("")
+        ax.grid(alpha=1, linewidth=1, axis="x")
+        ax.set_xticks([0])
+        ax.set_xticklabels([])
+        ax.set_xlim(left=3e4)
+        ax.set_title(
+            f"Month Babies Were Born\n(for babies born in {year})", loc="left"
         )
 
-    ax.spines["bottom"].set_visible(True)
-    ax.set_ylabel("")
-    ax.set_xlabel("")
-    ax.grid(alpha=1, linewidth=1, axis="x")
-    ax.set_xticks([0])
-    ax.set_xticklabels([])
-    ax.set_xlim(left=3e4)
-    plt.title(
-        f"Month Babies Were Born\n(for babies born in {year})", loc="left"
-    )
-
-    sns.despine(left=True, bottom=True)
+        sns.despine(ax=ax, left=True, bottom=True)
 
     # save plot as svg and png
     if save_plot:
         if path_save_dir is None:
             path_save_dir = Path.cwd().parent.parent
 
-        plt.savefig(
+        fig.savefig(
             path_save_dir / f"{year}_births_by_month.svg", bbox_inches="tight", dpi=dpi
         )
 
-        plt.savefig(
+        fig.savefig(
             path_save_dir / f"{year}_births_by_month.png", bbox_inches="tight", dpi=dpi
         )
-    else:
-        plt.show()
-
-
-def plot_births_by_month_violin(df, start_year=1981, end_year=2020, path_save_dir=None, dpi=300, save_plot=True):
-    """"Take the prepared df and output the violin plot of percentage change by month"""
-
-    dfp = percentage_birts_by_month(df, years_greater_than=1980)
-    dfp = dfp[(dfp['dob_yy'] >= start_year) & (dfp['dob_yy'] <= end_year)]
 
-    # round to 2 decimal places to look nice
-    dfp['percent_above_avg'] = np.round(dfp['percent_above_avg'],2)
+    return fig
 
-    print(dfp['dob_yy'].max())
-
-    TITLE = f"Monthly Increase/Decrease in Births, {start_year}-{end_year}"
-    X_LABEL = 'Percentage Above/Below Yearly Average'
-
-    # make plotly violin plot
-    fig = go.Figure(data=go.Violin(x=dfp["percent_above_avg"],
-                                y=dfp['birth_month'],
-                                
-                                # add a custom text using list comprehension and zip
-                                text = [f'{month}, {v:.2f}%' for month, v, in 
-                                        zip(dfp['dob_yy'],dfp['percent_above_avg'])],
-                                
-                                hoverinfo='text', # show the custom text for hover
-                                orientation='h', #horizontal orientation
-                                box_visible=False, # don't show box-plot
-                                meanline_visible=False, # hide meanline in violins
-                                line_color='dimgrey', 
-                                fillcolor='white',
-                                opacity=1,
-                                marker_symbol="circle",
-                                marker_color='dimgrey',
-                                marker_opacity=0.3, 
-                                marker_size=10,
-                                pointpos=0, # put scatters in middle of violin
-                                jitter=0.7, 
-                                scalemode='width',
-                                width=1.2,
-                                points='all',
-                                ))
 
+def style_violin_figure(fig, xmin, xmax, title, x_label):
+    """Lay out a violin plot of the percent above average births by month:
+    shade the negative (red) and positive (green) sides, and set the fonts
+    and axes.
+    """
 
     # add shaded regions
     shaded_region_list = []
 
-    # get min/max for shaded region
-    xmin = np.min(dfp['percent_above_avg'])*1.3
-    xmax = np.max(dfp['percent_above_avg'])*1.3
-
     # negative birth percentage area
     shaded_region_list.append(
                     dict(
@@ -191,9 +159,9 @@ def plot_births_by_month_violin(df, start_year=1981, end_year=2020, path_save_di
                     template='plotly_white',
                     margin=dict(l=2, r=2, t=25, b=2), # create a "tight" layout
                     xaxis=dict(range=[xmin, xmax], tickvals = [-10, -5, 0, 5, 10]),
-                    title=TITLE,
+                    title=title,
                     title_x=0.55, # title position
-                    titlefont=dict(family='DejaVu Sans', color='#333333', size=16), 
+                    title_font=dict(family='DejaVu Sans', color='#333333', size=16), 
                     shapes=shaded_region_list
                     )
 
@@ -204,9 +172,9 @@ def plot_births_by_month_violin(df, start_year=1981, end_year=2020, path_save_di
                     zeroline=True,
                     zerolinecolor='lightgrey',
                     zerolinewidth=2,
-                    title_text=X_LABEL,
+                    title_text=x_label,
                     tickfont=dict(family='DejaVu Sans', color='#333333', size=14), # set custom font
-                    titlefont=dict(family='DejaVu Sans', color='#333333', size=14),
+                    title_font=dict(family='DejaVu Sans', color='#333333', size=14),
                     fixedrange=False # allow zooming by not fixing range
                     )
 
@@ -214,6 +182,65 @@ def plot_births_by_month_violin(df, start_year=1981, end_year=2020, path_save_di
                     fixedrange=False
                     )
 
+
+def get_violin_title(dfp, start_year, end_year):
+    """Get the title of a violin plot, giving the years that are actually
+    plotted in dfp (e.g. only those after 1980 have a percent above average),
+    rather than the ones asked for.
+    """
+    if not dfp.empty:
+        start_year, end_year = int(dfp["dob_yy"].min()), int(dfp["dob_yy"].max())
+    return f"Monthly Increase/Decrease in Births, {start_year}-{end_year}"
+
+
+def plot_births_by_month_violin(df, start_year=1981, end_year=2020, path_save_dir=None, dpi=300, save_plot=True):
+    """"Take the prepared df and output the violin plot of percentage change by month"""
+    import plotly.graph_objects as go
+
+    dfp = percentage_birts_by_month(df, years_greater_than=1980)
+    dfp = dfp[(dfp['dob_yy'] >= start_year) & (dfp['dob_yy'] <= end_year)]
+
+    # round to 2 decimal places to look nice
+    dfp['percent_above_avg'] = np.round(dfp['percent_above_avg'],2)
+
+    print(dfp['dob_yy'].max())
+
+    TITLE = get_violin_title(dfp, start_year, end_year)
+    X_LABEL = 'Percentage Above/Below Yearly Average'
+
+    # make plotly violin plot
+    fig = go.Figure(data=go.Violin(x=dfp["percent_above_avg"],
+                                y=dfp['birth_month'],
+                                
+                                # add a custom text using list comprehension and zip
+                                text = [f'{month}, {v:.2f}%' for month, v, in 
+                                        zip(dfp['dob_yy'],dfp['percent_above_avg'])],
+                                
+                                hoverinfo='text', # show the custom text for hover
+                                orientation='h', #horizontal orientation
+                                box_visible=False, # don't show box-plot
+                                meanline_visible=False, # hide meanline in violins
+                                line_color='dimgrey', 
+                                fillcolor='white',
+                                opacity=1,
+                                marker_symbol="circle",
+                                marker_color='dimgrey',
+                                marker_opacity=0.3, 
+                                marker_size=10,
+                                pointpos=0, # put scatters in middle of violin
+                                jitter=0.7, 
+                                scalemode='width',
+                                width=1.2,
+                                points='all',
+                                ))
+
+
+    # get min/max for shaded region
+    xmin = np.min(dfp['percent_above_avg'])*1.3
+    xmax = np.max(dfp['percent_above_avg'])*1.3
+
+    style_violin_figure(fig, xmin, xmax, TITLE, X_LABEL)
+
     # other config options: https://plotly.com/python/configuration-options/
     # fig.show(config={"displayModeBar": False, "showTips": False})
 
@@ -223,15 +250,362 @@ def plot_births_by_month_violin(df, start_year=1981, end_year=2020, path_save_di
             path_save_dir = Path.cwd().parent.parent
 
         fig.write_image(path_save_dir / f"{start_year}-{end_year}_births_by_month_percent_above_avg.png", scale=2)
+
+    return fig
+
+
+
+
+
+
+# quantiles of each month shown on the pre-binned violin plots
+VIOLIN_QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+def summarize_violin(values, n_points=50, n_bins=512):
+    """Summarize the values of a violin by their kernel density estimate
+    (KDE) and quantiles, so that only the summary needs to be plotted.
+
+    The KDE is Gaussian, with Scott's rule for the bandwidth, over the span
+    plotly uses for its violins (two bandwidths past the smallest and largest
+    values). The values are first binned into n_bins bins, so the cost of the
+    KDE does not grow with the number of values.
+
+    Args:
+        values (np.ndarray): The values, e.g. the percent above average births.
+        n_points (int): Number of points to evaluate the KDE at.
+        n_bins (int): Number of bins the values are counted in.
+
+    Returns:
+        dict: x and density of the KDE (float32 arrays, the density as a
+            fraction of its maximum), the VIOLIN_QUANTILES and n, the number
+            of values.
+    """
+
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return None
+
+    std = values.std(ddof=1) if len(values) > 1 else 0.0
+    bandwidth = std * len(values) ** (-1 / 5) if std > 0 else 0.5
+
+    span = (values.min() - 2 * bandwidth, values.max() + 2 * bandwidth)
+    counts, edges = np.histogram(values, bins=n_bins, range=span)
+    centers = (edges[:-1] + edges[1:]) / 2
+
+    x = np.linspace(span[0], span[1], n_points)
+    density = np.exp(-0.5 * ((x[:, None] - centers[None, :]) / bandwidth) ** 2) @ counts
+
+    return {
+        "x": x.astype(np.float32),
+        "density": (density / density.max()).astype(np.float32),
+        "quantiles": np.quantile(values, VIOLIN_QUANTILES).astype(np.float32),
+        "n": len(values),
+    }
+
+
+def plot_violin_summary(dfp, title, x_label, n_points=50, width=1.2):
+    """Plot the percent above average births of each month as violins drawn
+    from their summaries (see summarize_violin), rather than from every
+    point, so the figure stays small however many years or states are in
+    dfp.
+
+    The arrays of the figure are float32, which plotly sends as compact
+    typed arrays, and the hover text is a template shared by all the months
+    rather than a string per point.
+
+    Args:
+        dfp (pd.DataFrame): Requires columns: birth_month, percent_above_avg.
+            E.g. from percentage_birts_by_month, or the months of every state
+            from percentage_births_by_month_grouped.
+        title (str): Title of the figure.
+        x_label (str): Label of the x axis.
+        n_points (int): Number of points of the outline of each violin.
+        width (float): Width of the violins, as in go.Violin.
+
+    Returns:
+        go.Figure: The figure.
+    """
+    import plotly.graph_objects as go
+
+    # months in order of the calendar, January at the bottom
+    values_by_month = {
+        str(month): values.to_numpy()
+        for month, values in dfp.groupby("birth_month", observed=True)[
+            "percent_above_avg"
+        ]
+    }
+    months = [m for m in MONTH_NAMES if m in values_by_month]
+
+    fig = go.Figure()
+    quantiles = []
+    for i, month in enumerate(months):
+        summary = summarize_violin(values_by_month[month], n_points=n_points)
+        if summary is None:
+            continue
+
+        # the outline of the violin, around both sides of the month's line
+        half_width = summary["density"] * np.float32(width / 2)
+        fig.add_trace(
+            go.Scatter(
+                x=np.concatenate([summary["x"], summary["x"][::-1]]),
+                y=np.concatenate([i + half_width, (i - half_width)[::-1]]),
+                fill="toself",
+                fillcolor="white",
+                line_color="dimgrey",
+                line_width=1,
+                hoverinfo="skip",
+                showlegend=False,
+            )
+        )
+        quantiles.append([i] + list(summary["quantiles"]) + [summary["n"]])
+
+    q = np.array(quantiles, dtype=np.float32).reshape(-1, len(VIOLIN_QUANTILES) + 2)
+    nan = np.full(len(q), np.nan, dtype=np.float32)
+
+    # interquartile range (and 5th to 95th percentiles) as lines, split by NaNs
+    for low, high, line_width in [(1, 5, 1), (2, 4, 5)]:
+        fig.add_trace(
+            go.Scatter(
+                x=np.column_stack([q[:, low], q[:, high], nan]).ravel(),
+                y=np.column_stack([q[:, 0], q[:, 0], nan]).ravel(),
+                mode="lines",
+                line_color="dimgrey",
+                line_width=line_width,
+                hoverinfo="skip",
+                showlegend=False,
+            )
+        )
+
+    fig.add_trace(
+        go.Scatter(
+            x=q[:, 3],
+            y=q[:, 0],
+            customdata=q[:, 1:],
+            text=[months[int(i)] for i in q[:, 0]],
+            mode="markers",
+            marker_color="white",
+            marker_line_color="dimgrey",
+            marker_line_width=2,
+            marker_size=8,
+            hovertemplate=(
+                "%{text}<br>median: %{x:.2f}%<br>"
+                "middle 50%: %{customdata[1]:.2f}% to %{customdata[3]:.2f}%<br>"
+                "middle 90%: %{customdata[0]:.2f}% to %{customdata[4]:.2f}%<br>"
+                "%{customdata[5]} months<extra></extra>"
+            ),
+            showlegend=False,
+        )
+    )
+
+    xmin = np.nanmin(dfp["percent_above_avg"]) * 1.3
+    xmax = np.nanmax(dfp["percent_above_avg"]) * 1.3
+    style_violin_figure(fig, xmin, xmax, title, x_label)
+    fig.update_yaxes(
+        tickvals=list(range(len(months))), ticktext=months, showgrid=False
+    )
+
+    return fig
+
+
+def export_births_by_month_violin_html(
+    df,
+    path_html,
+    start_year=1981,
+    end_year=2020,
+    include_plotlyjs="cdn",
+    n_points=50,
+):
+    """Export the violin plot of the percent change in births by month to
+    an HTML file, pre-binned (see plot_violin_summary).
+
+    plotly.js (over 3 MB) is not embedded in the file, but loaded from a
+    CDN, or from a shared copy, so a page of several plots only loads it once.
+
+    Args:
+        df (pd.DataFrame): The prepared birth data (see
+            plot_births_by_month_violin), or the output of
+            percentage_births_by_month_grouped, for the months of every state.
+        path_html (Path): Path of the HTML file.
+        start_year (int): First year to plot.
+        end_year (int): Last year to plot.
+        include_plotlyjs (str): "cdn", "directory" (plotly.min.js next to
+            the HTML file), or the path or URL of a shared plotly.min.js.
+            See go.Figure.write_html.
+        n_points (int): Number of points of the outline of each violin.
+
+    Returns:
+        go.Figure: The figure.
+    """
+
+    if "percent_above_avg" in getattr(df, "columns", []):
+        dfp = df
     else:
-        pass
+        dfp = percentage_birts_by_month(df, years_greater_than=1980)
+    dfp = dfp[(dfp["dob_yy"] >= start_year) & (dfp["dob_yy"] <= end_year)]
+
+    fig = plot_violin_summary(
+        dfp,
+        title=get_violin_title(dfp, start_year, end_year),
+        x_label="Percentage Above/Below Yearly Average",
+        n_points=n_points,
+    )
+    fig.write_html(path_html, include_plotlyjs=include_plotlyjs)
+
+    return fig
+
+
+###############################################################################
+# Batch rendering of figures
+###############################################################################
 
+# chart types that can be batch rendered
+CHARTS = ["births_by_month", "violin", "violin_html"]
 
 
+def figure_fingerprint(df, **params):
+    """Hash the data and parameters used to make a figure, so that
+    figures whose inputs have not changed can be skipped.
+    """
+    h = hashlib.md5(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
 
 
+def render_births_by_month(task):
+    """Render a births by month plot in a worker process.
+    task is a tuple of (df, year, path_save_dir, dpi).
+    """
+    df, year, path_save_dir, dpi = task
+    plot_births_by_month(
+        df, year=year, path_save_dir=path_save_dir, dpi=dpi, save_plot=True
+    )
+    return year
+
+
+def render_figures(
+    df,
+    start_year=1968,
+    end_year=2020,
+    charts=None,
+    path_save_dir=None,
+    dpi=300,
+    n_cores=4,
+    force=False,
+):
+    """Render a batch of figures over a range of years.
+
+    The matplotlib plots (one per year) are rendered in parallel in a pool of
+    worker processes. The plotly plots are exported from this process, so
+    that a single Kaleido process is started and reused for all of them.
+    Figures whose data and parameters are unchanged since the last render
+    (tracked in figures_manifest.json in path_save_dir) are skipped.
 
-def main():
+    Args:
+        df (pd.DataFrame): The prepared birth data (created using df_birth_no_geo_prep),
+            or a cube created with make_birth_cube.
+        start_year (int): First year to render.
+        end_year (int): Last year to render.
+        charts (list): Chart types to render, from CHARTS. All if None.
+        path_save_dir (Path): Folder to save the figures in.
+        dpi (int): Resolution of the matplotlib figures.
+        n_cores (int): Number of processes to render with.
+        force (bool): Render every figure, even if unchanged.
+
+    Returns:
+        list: Names of the figures that were rendered.
+    """
+    logger = logging.getLogger(__name__)
+
+    if charts is None:
+        charts = CHARTS
+
+    if path_save_dir is None:
+        path_save_dir = Path.cwd().parent.parent
+    path_save_dir = Path(path_save_dir)
+
+    # slice the data once, so that only a small df is sent to each worker
+    if not isinstance(df, dict):
+        df = make_birth_cube(df)
+
+    path_manifest = path_save_dir / "figures_manifest.json"
+    if path_manifest.exists():
+        manifest = json.loads(path_manifest.read_text())
+    else:
+        manifest = {}
+
+    def is_unchanged(name, fingerprint, file_names):
+        return (
+            not force
+            and manifest.get(name) == fingerprint
+            and all((path_save_dir / f).exists() for f in file_names)
+        )
+
+    rendered = []
+
+    if "births_by_month" in charts:
+        tasks = []
+        for year in range(start_year, end_year + 1):
+            df_year = filter_by_year(df, filter_cat="dob_yy", year=year)
+            if df_year.empty:
+                continue
+
+            name = f"{year}_births_by_month"
+            fingerprint = figure_fingerprint(df_year, chart=name, dpi=dpi)
+            if is_unchanged(name, fingerprint, [f"{name}.svg", f"{name}.png"]):
+                continue
+
+            tasks.append((df_year, year, path_save_dir, dpi))
+            manifest[name] = fingerprint
+            rendered.append(name)
+
+        with Pool(processes=n_cores) as pool:
+            for year in pool.imap_unordered(render_births_by_month, tasks):
+                logger.info(f"{year} births by month rendered")
+
+    if "violin" in charts:
+        dfp = percentage_birts_by_month(df)
+        dfp = dfp[(dfp["dob_yy"] >= start_year) & (dfp["dob_yy"] <= end_year)]
+
+        name = f"{start_year}-{end_year}_births_by_month_percent_above_avg"
+        fingerprint = figure_fingerprint(dfp, chart=name)
+        if not is_unchanged(name, fingerprint, [f"{name}.png"]):
+            plot_births_by_month_violin(
+                df,
+                start_year=start_year,
+                end_year=end_year,
+                path_save_dir=path_save_dir,
+                save_plot=True,
+            )
+            manifest[name] = fingerprint
+            rendered.append(name)
+
+    if "violin_html" in charts:
+        dfp = percentage_birts_by_month(df)
+        dfp = dfp[(dfp["dob_yy"] >= start_year) & (dfp["dob_yy"] <= end_year)]
+
+        # plotly.js is loaded from its CDN, so the file only holds the summaries
+        name = f"{start_year}-{end_year}_births_by_month_percent_above_avg_html"
+        file_name = f"{start_year}-{end_year}_births_by_month_percent_above_avg.html"
+        fingerprint = figure_fingerprint(dfp, chart=name)
+        if not is_unchanged(name, fingerprint, [file_name]):
+            export_births_by_month_violin_html(
+                dfp,
+                path_save_dir / file_name,
+                start_year=start_year,
+                end_year=end_year,
+            )
+            manifest[name] = fingerprint
+            rendered.append(name)
+
+    path_manifest.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+
+    logger.info(f"{len(rendered)} figures rendered")
+    return rendered
+
+
+def main(args):
     logger = logging.getLogger(__name__)
     logger.info("making figures from consolidated tables")
 
@@ -245,6 +619,22 @@ def main():
     # create dfp
     df = df_birth_no_geo_prep(df)
 
+    # aggregate once, so each plot only slices out the years it needs
+    df = make_birth_cube(df)
+
+    if args.batch:
+        render_figures(
+            df,
+            start_year=args.start_year,
+            end_year=args.end_year,
+            charts=args.charts,
+            path_save_dir=path_save_dir,
+            dpi=300,
+            n_cores=args.n_cores,
+            force=args.force,
+        )
+        return
+
     plot_births_by_month(
         df, year=1990, path_save_dir=path_save_dir, dpi=300, save_plot=True
     )
@@ -256,7 +646,44 @@ if __name__ == "__main__":
     log_fmt = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
     logging.basicConfig(level=logging.INFO, format=log_fmt)
 
+    parser = argparse.ArgumentParser(description="Make figures for reports")
+
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Render the charts for every year from start_year to end_year",
+    )
+
+    parser.add_argument(
+        "--start_year", type=int, default=1968, help="First year to render"
+    )
+
+    parser.add_argument("--end_year", type=int, default=2020, help="Last year to render")
+
+    parser.add_argument(
+        "--charts",
+        nargs="+",
+        choices=CHARTS,
+        default=CHARTS,
+        help="Chart types to render",
+    )
+
+    parser.add_argument(
+        "--n_cores",
+        type=int,
+        default=4,
+        help="Number of cores to use for multiprocessing",
+    )
+
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Render every figure, even if its data has not changed",
+    )
+
+    args = parser.parse_args()
+
     # not used in this stub but often useful for finding various files
     root_dir = Path(__file__).resolve().parents[2]
 
-    main()
+    main(args)
@@ -1,7 +1,24 @@
+import importlib.util
+import os
+import subprocess
 import sys
 
 REQUIRED_PYTHON = "python3"
 
+# modules imported by the data pipeline's workers and scripts
+FAST_MODULES = [
+    "src.data.data_prep_utils",
+    "src.data.make_dataset",
+    "src.visualization.visualize",
+]
+
+# plotting libraries, only to be imported when a figure is made
+PLOTTING_MODULES = ["matplotlib", "seaborn", "plotly"]
+
+# seconds importing a module may take (cumulative, with -X importtime), on
+# top of importing pandas (matplotlib.pyplot alone takes longer than this)
+IMPORT_TIME_BUDGET = 0.3
+
 
 def main():
     system_major = sys.version_info.major
@@ -17,8 +34,68 @@ def main():
         raise TypeError(
             "This project requires Python {}. Found: Python {}".format(
                 required_major, sys.version))
-    else:
-        print(">>> Development environment passes all tests!")
+
+    check_import_times()
+    print(">>> Development environment passes all tests!")
+
+
+def time_import(module, repeat=3):
+    """Import a module in a fresh interpreter, with -X importtime (the best
+    of repeat runs).
+
+    Returns:
+        tuple: (seconds importing the module took, including everything it
+            imported but pandas, the plotting modules left in sys.modules)
+    """
+    code = (
+        "import sys\n"
+        "import {}\n"
+        "print(' '.join(m for m in {} if m in sys.modules))\n"
+    ).format(module, PLOTTING_MODULES)
+
+    seconds = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        )
+
+        # lines of "import time: self [us] | cumulative | imported package"
+        cumulative = {}
+        for line in result.stderr.splitlines():
+            fields = [field.strip() for field in line.split("|")]
+            if len(fields) == 3 and fields[2] in (module, "pandas"):
+                cumulative[fields[2]] = int(fields[1]) / 1e6
+
+        seconds.append(cumulative[module] - cumulative.get("pandas", 0))
+
+    return min(seconds), result.stdout.split()
+
+
+def check_import_times():
+    """Check the pipeline's modules import quickly, and without the plotting
+    libraries, so Pool workers and --help start fast. Each module is
+    imported in a fresh interpreter, so everything it pulls in is counted.
+    """
+    if importlib.util.find_spec("pandas") is None:
+        print(">>> Packages not installed yet, skipping the import time check")
+        return
+
+    for module in FAST_MODULES:
+        seconds, plotting = time_import(module)
+        if plotting:
+            raise ImportError(
+                "{} imports plotting libraries: {}".format(module, plotting))
+        if seconds > IMPORT_TIME_BUDGET:
+            raise ImportError(
+                "{} takes {:.2f} s to import, over the budget of {} s".format(
+                    module, seconds, IMPORT_TIME_BUDGET))
+        print(">>> {} imports in {:.2f} s (on top of pandas)".format(
+            module, seconds))
 
 
 if __name__ == '__main__':
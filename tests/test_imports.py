@@ -0,0 +1,22 @@
+import pytest
+
+from test_environment import (
+    FAST_MODULES,
+    IMPORT_TIME_BUDGET,
+    PLOTTING_MODULES,
+    time_import,
+)
+
+
+@pytest.mark.parametrize("module", FAST_MODULES)
+def test_pipeline_imports_quickly_without_plotting(module):
+    seconds, plotting = time_import(module)
+
+    assert plotting == [], f"{module} imports {plotting}"
+    assert seconds <= IMPORT_TIME_BUDGET
+
+
+@pytest.mark.parametrize("plotting_module", PLOTTING_MODULES)
+def test_plotting_modules_are_detected(plotting_module):
+    _, plotting = time_import(plotting_module, repeat=1)
+    assert plotting_module in plotting
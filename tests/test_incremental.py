@@ -0,0 +1,72 @@
+import argparse
+import os
+import shutil
+from pathlib import Path
+
+import pandas as pd
+
+from src.data import make_dataset
+from src.data.benchmark import EXTERNAL_FILES, make_synthetic_csv
+from src.data.data_prep_utils import csv_to_cache, df_from_csv_no_geo
+
+PROJECT_DIR = Path(__file__).resolve().parents[1]
+
+
+def make_data_folder(tmp_path):
+    """Lay out a data folder (raw and external) with a synthetic csv."""
+    folder_data = tmp_path / "data"
+    (folder_data / "external").mkdir(parents=True)
+    for file_name in EXTERNAL_FILES:
+        shutil.copy(PROJECT_DIR / "data/external" / file_name, folder_data / "external")
+
+    file_path = folder_data / "raw" / "natl2004.csv"
+    make_synthetic_csv(file_path, 2004, 500, folder_data / "external", seed=0)
+    return file_path
+
+
+def build(file_path, folder_partials):
+    """Run an incremental build of the births_simple table."""
+    make_dataset.args = argparse.Namespace(chunksize=None, n_cores=1, no_split=True)
+    tables, _ = make_dataset.main(file_path.parent, folder_partials=folder_partials)
+    return tables["births_simple"]
+
+
+def test_changed_csv_is_not_read_from_its_cache(tmp_path):
+    file_path = make_data_folder(tmp_path)
+    folder_partials = tmp_path / "data/interim/partials"
+
+    csv_to_cache(file_path)
+    before = build(file_path, folder_partials)
+
+    # replace the csv, as a re-download would (with a later mtime)
+    stat = file_path.stat()
+    make_synthetic_csv(file_path, 2004, 400, file_path.parent.parent / "external", seed=1)
+    os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    after = build(file_path, folder_partials)
+
+    assert before["births"].sum() == 500
+    assert after["births"].sum() == 400
+
+    # the counts are those of the new csv
+    expected = df_from_csv_no_geo(file_path)
+    pd.testing.assert_frame_equal(
+        after.reset_index(drop=True), expected.reset_index(drop=True), check_dtype=False
+    )
+
+
+def test_rebuilt_cache_is_reprocessed(tmp_path):
+    file_path = make_data_folder(tmp_path)
+    folder_partials = tmp_path / "data/interim/partials"
+
+    build(file_path, folder_partials)
+
+    # making a cache changes what the csv is read from, so it is processed again
+    csv_to_cache(file_path)
+    manifest = make_dataset.load_manifest(folder_partials)
+    changed, unchanged, _ = make_dataset.find_changed_files(
+        [file_path],
+        manifest,
+        options={"per_birth": False, "tables": make_dataset.TABLE_NAMES},
+    )
+    assert changed == [file_path] and unchanged == []
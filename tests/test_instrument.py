@@ -0,0 +1,74 @@
+import time
+
+import pandas as pd
+import pytest
+
+from src.data.data_prep_utils import (
+    csv_to_cache,
+    df_from_csv_all,
+    iter_fields,
+    load_state_lookup,
+)
+from src.data.instrument import (
+    stage,
+    start_recording,
+    stop_recording,
+    summarize_records,
+)
+
+from test_incremental import make_data_folder
+
+
+def test_nested_stages_are_not_counted_twice():
+    start_recording()
+    start = time.perf_counter()
+    with stage("read"):
+        time.sleep(0.05)
+        with stage("rename"):
+            time.sleep(0.05)
+    total = time.perf_counter() - start
+    records = stop_recording()
+
+    seconds = {record["stage"]: record["seconds"] for record in records}
+    assert seconds["rename"] >= 0.05
+    assert 0.05 <= seconds["read"] < 0.1
+    assert sum(seconds.values()) <= total
+
+
+@pytest.mark.parametrize("chunksize", [None, 100])
+@pytest.mark.parametrize("cached", [False, True])
+def test_stage_times_sum_to_no_more_than_the_total(tmp_path, chunksize, cached):
+    file_path = make_data_folder(tmp_path)
+    load_state_lookup(file_path.parent.parent / "external")
+    if cached:
+        csv_to_cache(file_path)
+
+    start_recording()
+    start = time.perf_counter()
+    df_from_csv_all(file_path, chunksize=chunksize)
+    total = time.perf_counter() - start
+    records = stop_recording()
+
+    df = summarize_records(records)
+    assert df["seconds"].sum() <= total
+
+    # every stage records the rows it put out
+    assert all(record["rows_out"] is not None for record in records)
+    assert (df["rows_out"] > 0).all()
+
+
+@pytest.mark.parametrize("chunksize", [None, 100, 500])
+@pytest.mark.parametrize("cached", [False, True])
+def test_read_stage_is_recorded_once_per_chunk(tmp_path, chunksize, cached):
+    file_path = make_data_folder(tmp_path)
+    if cached:
+        csv_to_cache(file_path)
+
+    start_recording()
+    df_list = list(iter_fields(file_path, ["dob_yy", "dob_mm"], chunksize=chunksize))
+    records = [record for record in stop_recording() if record["stage"] == "read"]
+
+    result = pd.concat(df_list)
+    assert len(records) == len(df_list)
+    assert sum(record["rows_out"] for record in records) == len(result)
+    assert all(record["rows_out"] > 0 for record in records)